@@ -0,0 +1,459 @@
+import os
+import io
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import subprocess
+import tempfile
+import contextlib
+import numpy as np
+from qiskit import transpile
+
+from PIL import Image
+
+import picture
+import client
+
+######################### BENCHMARKS #####################################################
+
+def random_blocks(num_blocks, block_size=4, seed=0):
+    """Create num_blocks random groups of block_size 8-bit intensities, as run_circuits receives them."""
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(num_blocks, block_size)).tolist()
+
+def bench_circuit_build(num_blocks=50):
+    """Per-block time to build and transpile the image circuit, from scratch (as run_circuits used to)
+    and from the cached circuit template.
+    :return: dictionary of mean seconds per block for each method"""
+    blocks = random_blocks(num_blocks)
+    aer_sim = picture.get_backend('aer_simulator')
+
+    start = time.perf_counter()
+    for values in blocks:
+        transpile(picture.build_image_circuit(values), aer_sim)
+    scratch = (time.perf_counter() - start) / num_blocks
+
+    # the template is built once per backend, which is timed separately from the per-block splicing
+    picture._CIRCUIT_TEMPLATES.clear()
+    start = time.perf_counter()
+    picture.get_circuit_template(aer_sim)
+    template_setup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for values in blocks:
+        picture.build_templated_circuit(values, aer_sim)
+    templated = (time.perf_counter() - start) / num_blocks
+
+    return {'scratch': scratch, 'template_setup': template_setup, 'templated': templated}
+
+def bench_teleport_circuit(max_position_qubits=4, repeats=20):
+    """Time to construct the teleportation part of the image circuit (create_bell_pair, alice_gates, measure_and_send
+    and bob_gates for every NEQR qubit), for image subsets of 2^k pixels with k from 1 to max_position_qubits.
+    :return: dictionary of mean seconds per circuit for each k"""
+    timings = {}
+    for position_qubits in range(1, max_position_qubits+1):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            qc_image, cr, crz, crx = picture.create_image_circuit(position_qubits)
+            picture.teleport_image(qc_image, cr, crz, crx)
+        timings[position_qubits] = (time.perf_counter() - start) / repeats
+    return timings
+
+def bench_run_circuits(num_blocks=20, backends=('aer_simulator', 'numpy')):
+    """Time taken by run_circuits to teleport a single image subset end to end (build, simulate, decode).
+    :return: dictionary of mean seconds per block for each backend"""
+    blocks = random_blocks(num_blocks)
+    timings = {}
+    for backend in backends:
+        picture.run_circuits(blocks[0], backend)  # warm up the backend and circuit template
+        start = time.perf_counter()
+        for values in blocks:
+            if (picture.run_circuits(values, backend) != values):
+                raise AssertionError(backend + " backend did not teleport " + str(values) + " unchanged")
+        timings[backend] = (time.perf_counter() - start) / num_blocks
+    return timings
+
+def synthetic_image(path, num_bytes, seed=0):
+    """Write a PNG of random grayscale noise to path, roughly num_bytes long (noise does not compress).
+    :return: the size of the file in bytes"""
+    side = max(1, int(num_bytes**0.5))
+    pixels = np.random.default_rng(seed).integers(0, 256, size=(side, side), dtype=np.uint8)
+    Image.fromarray(pixels).save(path)
+    return os.path.getsize(path)
+
+def bench_send_file(sizes=(256, 1024, 4096), backend='numpy'):
+    """Time taken by send_file to transfer synthetic images of increasing size (with its own BB84 key pool),
+    checking that every file arrives unchanged. The output of send_file is discarded.
+    :return: dictionary of (seconds, file size in bytes) for each requested size"""
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'src') + os.sep
+        dst = os.path.join(tmp, 'dst') + os.sep
+        os.makedirs(src)
+        os.makedirs(dst)
+        for size in sizes:
+            file_name = 'payload_' + str(size) + '.png'
+            file_size = synthetic_image(src + file_name, size)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                sent = picture.send_file(src, file_name, dst, backend=backend, progress=None, sinks=())
+            timings[size] = (time.perf_counter() - start, file_size)
+            with open(src + file_name, 'rb') as original, open(dst + file_name, 'rb') as received:
+                if (not sent or original.read() != received.read()):
+                    raise AssertionError("send_file did not transfer " + file_name + " unchanged")
+    return timings
+
+def bench_workers(max_workers, num_blocks=64, batch_size=8):
+    """Throughput of teleport_blocks with 1 to max_workers worker processes.
+    :return: dictionary of blocks teleported per second for each worker count"""
+    blocks = random_blocks(num_blocks)
+    throughput = {}
+    for workers in range(1, max_workers+1):
+        start = time.perf_counter()
+        for _ in picture.teleport_blocks(blocks, batch_size, workers):
+            pass
+        throughput[workers] = num_blocks / (time.perf_counter() - start)
+    return throughput
+
+def bench_block_sizes(max_position_qubits, num_bytes=256, batch_size=8):
+    """Throughput of run_circuits_batch when teleporting num_bytes in image subsets of 2^k pixels,
+    for k from 1 to max_position_qubits.
+    :return: dictionary of bytes teleported per second, and mean shots per circuit, for each k"""
+    throughput = {}
+    for position_qubits in range(1, max_position_qubits+1):
+        block_size = 2**position_qubits
+        blocks = random_blocks(max(1, num_bytes//block_size), block_size)
+        shots_used = []
+        start = time.perf_counter()
+        picture.run_circuits_batch(blocks, batch_size, shots_used=shots_used)
+        throughput[position_qubits] = (len(blocks)*block_size / (time.perf_counter() - start),
+                                       picture.summarize_shots(shots_used)['mean_shots'])
+    return throughput
+
+def bench_backends(num_blocks=50, batch_size=8):
+    """Throughput of run_circuits_batch with the Aer simulator and with the NumPy engine, checking that both decode
+    the same bytes for every block (test_picture.py cross-checks their measurement counts).
+    :return: dictionary of blocks teleported per second for each backend"""
+    blocks = random_blocks(num_blocks)
+
+    throughput = {}
+    for backend in ('aer_simulator', 'numpy'):
+        start = time.perf_counter()
+        processed = picture.run_circuits_batch(blocks, batch_size, backend)
+        throughput[backend] = num_blocks / (time.perf_counter() - start)
+        if (processed != blocks):
+            raise AssertionError(backend + " backend did not teleport the blocks unchanged")
+    return throughput
+
+def bench_teleport_modes(num_blocks=8, batch_size=8):
+    """Compare the teleport modes of the image circuit (see picture.build_image_circuit), whose equivalence is tested
+    in test_picture.py.
+    :return: dictionary of the gates, measurements and depth of the transpiled circuit template, and blocks
+        teleported per second by run_circuits_batch, for each mode"""
+    blocks = random_blocks(num_blocks)
+    aer_sim = picture.get_backend('aer_simulator')
+
+    results = {}
+    for mode in picture.TELEPORT_MODES:
+        results[mode] = picture.circuit_stats(picture.build_templated_circuit(blocks[0], aer_sim, mode))
+        start = time.perf_counter()
+        if (picture.run_circuits_batch(blocks, batch_size, teleport_mode=mode) != blocks):
+            raise AssertionError("the " + mode + " circuits did not teleport the blocks unchanged")
+        results[mode]['blocks_per_s'] = num_blocks / (time.perf_counter() - start)
+    return results
+
+def bench_block_cache(num_blocks=200, distinct=20, batch_size=8):
+    """Throughput of teleport_blocks on a repetitive payload (num_blocks drawn from distinct blocks), without and
+    with a BlockCache.
+    :return: dictionary of blocks teleported per second without and with the cache, and the cache hit rate"""
+    pattern = random_blocks(distinct)
+    blocks = [pattern[i % distinct] for i in range(num_blocks)]
+    throughput = {}
+    for name, cache in (('uncached', None), ('cached', picture.BlockCache())):
+        start = time.perf_counter()
+        processed = list(picture.teleport_blocks(blocks, batch_size, cache=cache))
+        throughput[name] = num_blocks / (time.perf_counter() - start)
+        if (processed != blocks):
+            raise AssertionError(name + " teleportation did not return the blocks unchanged")
+    throughput['hit_rate'] = cache.stats()['hit_rate']
+    return throughput
+
+def _count_pixels_strings(counts_neqr, values):
+    """The string based decoding run_circuits_batch used before the shot memory was decoded as integers: the
+    expected outcome of each pixel is formatted as a bit string and looked up among the keys of the counts."""
+    position_qubits = picture.get_position_qubits(values)
+    counts = [0]*len(values)
+    expected = {format(pixel, '0'+str(position_qubits)+'b')+format(value, '08b'): pixel
+                for pixel, value in enumerate(values)}
+    for key in counts_neqr.keys():
+        if (key[4:] in expected):
+            counts[expected[key[4:]]] += counts_neqr[key]
+    return counts
+
+def bench_decoder(num_blocks=4096, noise_levels=(0.0, 0.01, 0.05)):
+    """Decoding throughput on the shot memory of num_blocks blocks sampled by the NumPy engine: with bincounts and
+    maximum-likelihood decoding of integer outcomes, and with the string keyed counts it replaced (which could not
+    decode noisy outcomes). Also the accuracy and shots of run_circuits_batch at each noise level.
+    :return: dictionary of blocks decoded per second by each method, and of (blocks per second, fraction of
+        wrongly decoded pixels, mean shots per block) for each noise level"""
+    blocks = random_blocks(num_blocks)
+    shot_count = picture.shots_for_block_size(2)
+    results = {}
+
+    memory = picture.sample_neqr_memory(blocks, shot_count)
+    start = time.perf_counter()
+    picture.decode_histograms(picture.histogram_memory(memory, 2))
+    results['integers'] = num_blocks / (time.perf_counter() - start)
+
+    counts_list = picture.sample_neqr_counts(blocks, shot_count)
+    start = time.perf_counter()
+    for counts_neqr, values in zip(counts_list, blocks):
+        _count_pixels_strings(counts_neqr, values)
+    results['strings'] = num_blocks / (time.perf_counter() - start)
+
+    for noise in noise_levels:
+        shots_used = []
+        start = time.perf_counter()
+        processed = picture.run_circuits_batch(blocks, num_blocks, 'numpy', noise, shots_used=shots_used)
+        seconds = time.perf_counter() - start
+        results[('noise', noise)] = (num_blocks / seconds, float(np.mean(np.array(processed) != np.array(blocks))),
+                                     picture.summarize_shots(shots_used)['mean_shots'])
+    return results
+
+def bench_compression(num_bytes=2**20):
+    """Compression ratio and throughput of each codec of the compression stage of send_file, on the raw pixels of a
+    synthetic image with flat regions and gradients (as in an uncompressed BMP or TIFF).
+    :return: dictionary of (compression ratio, MB compressed per second) for each codec"""
+    side = int(num_bytes**0.5)
+    pixels = np.zeros((side, side), dtype=np.uint8)
+    pixels[side//4:3*side//4, side//4:3*side//4] = 200
+    pixels[:, :side//8] = np.arange(side//8, dtype=np.uint8)
+    data = io.BytesIO(pixels.tobytes())
+
+    results = {}
+    for codec in picture.COMPRESSION_CODECS:
+        data.seek(0)
+        start = time.perf_counter()
+        compressed = picture.compress_file(data, codec)
+        seconds = time.perf_counter() - start
+        size = compressed.seek(0, os.SEEK_END) if compressed is not None else len(pixels.tobytes())
+        results[codec] = (side*side/size, side*side/2**20/seconds)
+    return results
+
+def bench_daemon_latency(num_bytes=64, runs=2, backend='aer_simulator'):
+    """Latency of sending a small synthetic image with a cold CLI run (python picture.py), which imports qiskit, runs
+    BB84 and builds its circuit templates each time, and with a request to a warm teleport service (python client.py
+    against python picture.py --serve), checking that every file arrives unchanged.
+    :return: dictionary of the mean seconds per transfer of each way, and of the service's start up time"""
+    scripts = os.path.dirname(os.path.abspath(picture.__file__))
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    url = 'http://127.0.0.1:' + str(port)
+    latency = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'src') + os.sep
+        os.makedirs(src)
+        synthetic_image(src + 'payload.png', num_bytes)
+
+        def transfer(command, dst):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + command + ['payload.png', '--mentee', src, '--mentor', dst],
+                           check=True, stdout=subprocess.DEVNULL, cwd=scripts)
+            seconds = time.perf_counter() - start
+            with open(src + 'payload.png', 'rb') as original, open(dst + 'payload.png', 'rb') as received:
+                if (original.read() != received.read()):
+                    raise AssertionError(command[0] + " did not transfer payload.png unchanged")
+            return seconds
+
+        latency['cold_cli'] = np.mean([transfer(['picture.py', '--backend', backend, '--concurrency', '1'],
+                                                os.path.join(tmp, 'cold' + str(run)) + os.sep) for run in range(runs)])
+
+        start = time.perf_counter()
+        # the service may only send images from src to inside its mentor folder
+        warm = os.path.join(tmp, 'warm')
+        service = subprocess.Popen([sys.executable, 'picture.py', '--serve', '--port', str(port), '--backend', backend,
+                                    '--concurrency', '1', '--mentee', src, '--mentor', warm],
+                                   stdout=subprocess.DEVNULL, cwd=scripts)
+        try:
+            # wait for the service to have warmed up and be listening
+            while True:
+                try:
+                    client.service_health(url, timeout=1.0)
+                    break
+                except OSError:
+                    if (service.poll() is not None):
+                        raise RuntimeError("the teleport service exited with code " + str(service.returncode))
+                    time.sleep(0.1)
+            latency['service_start'] = time.perf_counter() - start
+            latency['warm_service'] = np.mean([transfer(['client.py', '--url', url, '--backend', backend],
+                                                        os.path.join(warm, str(run)) + os.sep)
+                                               for run in range(runs)])
+        finally:
+            service.terminate()
+            service.wait()
+    return latency
+
+def bench_bb84(raw_bits=(100, 10000, 100000)):
+    """Time taken by get_bb84_keys to distribute keys from each number of raw bits.
+    :return: dictionary of (seconds, sifted key length) for each number of raw bits"""
+    timings = {}
+    for n in raw_bits:
+        start = time.perf_counter()
+        a_key, b_key = picture.get_bb84_keys(n, key_length=None)
+        timings[n] = (time.perf_counter() - start, len(a_key))
+    return timings
+
+def _xor_encrypt_strings(data, key):
+    """The string based encryption send_file used before xor_encrypt worked on byte arrays: every byte is formatted
+    as an 8-bit string, parsed back to XOR it with its key byte, and formatted again."""
+    encrypted = []
+    for byte, key_byte in zip(data, key):
+        msg = format(byte, '08b')
+        encrypted.append(bin(int(msg, 2)^int(format(key_byte, '08b'), 2))[2:].zfill(len(msg)))
+    return encrypted
+
+def bench_xor(megabytes=(1, 4)):
+    """Encryption throughput of xor_encrypt on whole byte arrays, and of the per-byte string round trip it replaced
+    (on the first MB only, as it is far slower).
+    :return: dictionary of MB encrypted per second by each method"""
+    rng = np.random.default_rng(0)
+    throughput = {}
+    for size in megabytes:
+        data = rng.integers(0, 256, size=size*2**20, dtype=np.uint8).tobytes()
+        key = rng.integers(0, 256, size=size*2**20, dtype=np.uint8).tobytes()
+        start = time.perf_counter()
+        picture.xor_encrypt(data, key)
+        throughput[('array', size)] = size / (time.perf_counter() - start)
+    start = time.perf_counter()
+    _xor_encrypt_strings(data[:2**20], key[:2**20])
+    throughput[('strings', 1)] = 1 / (time.perf_counter() - start)
+    return throughput
+
+def _jsonable(results):
+    """Convert benchmark results to JSON types: dictionary keys to strings, tuples to lists."""
+    if isinstance(results, dict):
+        return {(key if isinstance(key, str) else '/'.join(map(str, key)) if isinstance(key, tuple) else str(key)):
+                _jsonable(value) for key, value in results.items()}
+    if isinstance(results, (tuple, list)):
+        return [_jsonable(value) for value in results]
+    return results
+
+def write_json(path, results, args):
+    """Write the results of a benchmark run to path as JSON, along with the settings and environment they were
+    measured in, so runs on different versions can be compared."""
+    import qiskit
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': vars(args),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'numpy': np.__version__,
+                        'qiskit': qiskit.__qiskit_version__['qiskit-terra']},
+        'results': _jsonable(results),
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+######################### MAIN ###########################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks for the picture.py teleportation pipeline")
+    parser.add_argument("--blocks", type=int, default=50, help="number of 4 byte blocks to benchmark with")
+    parser.add_argument("--position-qubits", type=int, default=4, help="maximum k for 2^k pixel image subsets")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="maximum number of worker processes")
+    parser.add_argument("--file-sizes", type=int, nargs='+', default=[256, 1024, 4096],
+                        help="approximate sizes in bytes of the synthetic images sent with send_file")
+    parser.add_argument("--file-backend", default='numpy', help="backend used by send_file (aer_simulator or numpy)")
+    parser.add_argument("--daemon-runs", type=int, default=2, help="transfers timed with a cold CLI run and with the "
+                                                                   "teleport service (0 to skip)")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+    results = {}
+
+    teleport = results['teleport_circuit'] = bench_teleport_circuit(args.position_qubits)
+    print("Teleportation circuit construction (bell pairs, alice/bob gates), per circuit:")
+    for position_qubits, seconds in teleport.items():
+        print("  k=%d (%2d qubits):    %.3f ms" % (position_qubits, position_qubits+10, 1000*seconds))
+
+    build = results['circuit_build'] = bench_circuit_build(args.blocks)
+    print("Circuit build + transpile, per block of 4 bytes:")
+    print("  from scratch:      %.3f ms" % (1000*build['scratch']))
+    print("  from template:     %.3f ms (one-off template setup: %.1f ms)"
+          % (1000*build['templated'], 1000*build['template_setup']))
+    print("  speedup:           %.1fx" % (build['scratch']/build['templated']))
+
+    xor = results['xor'] = bench_xor()
+    print("XOR encryption throughput:")
+    for (method, size), mb_per_s in xor.items():
+        print("  %-7s %2d MB:       %.1f MB/s" % (method, size, mb_per_s))
+
+    compression = results['compression'] = bench_compression()
+    print("Compression of 1 MB of raw image pixels before encryption:")
+    for codec, (ratio, mb_per_s) in compression.items():
+        print("  %-18s %.1fx smaller, %.1f MB/s" % (codec + ":", ratio, mb_per_s))
+
+    bb84 = results['bb84'] = bench_bb84()
+    print("BB84 key distribution:")
+    for n, (seconds, key_length) in bb84.items():
+        print("  %7d raw bits:    %.3f s (%d bit keys)" % (n, seconds, key_length))
+
+    run = results['run_circuits'] = bench_run_circuits()
+    print("run_circuits end to end, per block of 4 bytes:")
+    for backend, seconds in run.items():
+        print("  %-18s %.3f ms" % (backend + ":", 1000*seconds))
+
+    decoder = results['decoder'] = bench_decoder()
+    print("Decoding throughput (NumPy engine outcomes):")
+    print("  integer bincounts: %.0f blocks/s" % decoder['integers'])
+    print("  string counts:     %.0f blocks/s (exact matches only, no decoding)" % decoder['strings'])
+    for noise in (0.0, 0.01, 0.05):
+        blocks_per_s, error_rate, mean_shots = decoder[('noise', noise)]
+        print("  noise %.2f:        %.0f blocks/s end to end, %.4f %% wrong pixels, %.1f shots"
+              % (noise, blocks_per_s, 100*error_rate, mean_shots))
+
+    modes = results['teleport_modes'] = bench_teleport_modes(args.blocks)
+    print("Teleport modes (equivalence tested in test_picture.py), per transpiled circuit of 4 bytes:")
+    for mode, stats in modes.items():
+        print("  %-18s %d gates, %d measurements, depth %d, %.1f blocks/s"
+              % (mode + ":", stats['gates'], stats['measurements'], stats['depth'], stats['blocks_per_s']))
+
+    backends = results['backends'] = bench_backends(args.blocks)
+    print("Teleportation throughput by backend:")
+    for backend, blocks_per_s in backends.items():
+        print("  %-18s %.1f blocks/s" % (backend + ":", blocks_per_s))
+
+    caching = results['block_cache'] = bench_block_cache(4*args.blocks, max(1, args.blocks//10))
+    print("Teleportation throughput on a repetitive payload:")
+    print("  uncached:          %.1f blocks/s" % caching['uncached'])
+    print("  cached:            %.1f blocks/s (%.0f %% hit rate)" % (caching['cached'], 100*caching['hit_rate']))
+
+    scaling = results['workers'] = bench_workers(args.workers, args.blocks)
+    print("Teleportation throughput by number of worker processes:")
+    for workers, blocks_per_s in scaling.items():
+        print("  %3d workers:       %.1f blocks/s (%.2fx)" % (workers, blocks_per_s, blocks_per_s/scaling[1]))
+
+    sizes = results['block_sizes'] = bench_block_sizes(args.position_qubits, 4*args.blocks)
+    print("Teleportation throughput by image subset size (2^k pixels):")
+    for position_qubits, (bytes_per_s, mean_shots) in sizes.items():
+        print("  k=%d (%3d pixels, %6.1f shots): %.1f bytes/s"
+              % (position_qubits, 2**position_qubits, mean_shots, bytes_per_s))
+
+    files = results['send_file'] = bench_send_file(args.file_sizes, args.file_backend)
+    print("send_file on synthetic images (" + args.file_backend + " backend):")
+    for size, (seconds, file_size) in files.items():
+        print("  %6d bytes:      %.2f s (%.1f bytes/s)" % (file_size, seconds, file_size/seconds))
+
+    if args.daemon_runs:
+        daemon = results['daemon_latency'] = bench_daemon_latency(runs=args.daemon_runs, backend=args.file_backend)
+        print("Latency of a small transfer (" + args.file_backend + " backend):")
+        print("  cold CLI run:      %.2f s" % daemon['cold_cli'])
+        print("  warm service:      %.2f s (%.1fx faster, after %.2f s of start up)"
+              % (daemon['warm_service'], daemon['cold_cli']/daemon['warm_service'], daemon['service_start']))
+
+    if args.json:
+        write_json(args.json, results, args)
+        print("Results written to " + args.json)
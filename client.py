@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+# Thin client of the teleport service (python picture.py --serve). It only needs the standard library, so that
+# submitting a transfer doesn't pay for importing qiskit, which the service has already done.
+
+DEFAULT_SERVICE_URL = "http://127.0.0.1:8765"
+
+def _request(url, body=None, timeout=None):
+    """
+    Send a JSON request to the service (POST if it has a body, GET otherwise).
+    :return: the HTTP status and the JSON reply
+    """
+    data = None if body is None else json.dumps(body).encode()
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as error:
+        return error.code, json.load(error)
+
+def submit_transfer(mentee_path, file_name, mentor_path, url=DEFAULT_SERVICE_URL, wait=True, busy_timeout=60.0,
+                    **options):
+    """
+    Submit a send_file transfer to the teleport service. While its queue is full, the submission is retried until
+    busy_timeout seconds have passed.
+    :param mentee_path: path to the folder of the image, resolved here since the service may run elsewhere
+    :param file_name: name of the image
+    :param mentor_path: path to the folder the image is teleported to
+    :param url: url of the service
+    :param wait: wait for the transfer to be done, or return as soon as it is queued
+    :param options: options of the transfer, arguments of send_file (see TeleportService.OPTIONS)
+    :return: the job of the transfer, with its status, success, error and summary once it is done
+    """
+    body = {'mentee_path': os.path.join(os.path.abspath(mentee_path), ""), 'file_name': file_name,
+            'mentor_path': os.path.join(os.path.abspath(mentor_path), ""), 'options': options, 'wait': wait}
+    deadline = time.monotonic() + busy_timeout
+    while True:
+        status, reply = _request(url + "/transfers", body)
+        if (status == 503 and time.monotonic() < deadline):
+            # the queue is full, back off until it drains
+            time.sleep(1.0)
+            continue
+        if (status not in (200, 202)):
+            raise RuntimeError("teleport service refused " + file_name + ": " + reply['error'])
+        return reply
+
+def transfer_status(job_id, url=DEFAULT_SERVICE_URL):
+    """:return: the job with id job_id, with its status, success, error and summary once it is done"""
+    status, reply = _request(url + "/transfers/" + job_id)
+    if (status != 200):
+        raise KeyError(job_id)
+    return reply
+
+def service_health(url=DEFAULT_SERVICE_URL, timeout=None):
+    """:return: the number of transfers pending in the service and its key pool metrics"""
+    return _request(url + "/health", timeout=timeout)[1]
+
+######################### EXAMPLE ######################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Submit image transfers to the teleport service")
+    parser.add_argument("files", nargs="+", help="names of the images to send")
+    parser.add_argument("--mentee", default=os.path.join(".", "mentee", ""), help="mentee folder path")
+    parser.add_argument("--mentor", default=os.path.join(".", "mentor", ""), help="mentor folder path")
+    parser.add_argument("--url", default=DEFAULT_SERVICE_URL, help="url of the teleport service")
+    parser.add_argument("--backend", help="simulator backend, aer_simulator or numpy")
+    parser.add_argument("--teleport-mode", help="how the teleportation circuit is compiled")
+    parser.add_argument("--compression", help="compress the images before encrypting them")
+    parser.add_argument("--no-wait", action="store_true", help="return once the transfers are queued")
+    args = parser.parse_args()
+
+    options = {name: value for name, value in (('backend', args.backend), ('teleport_mode', args.teleport_mode),
+                                               ('compression', args.compression)) if value is not None}
+    os.makedirs(args.mentor, exist_ok=True)
+    for file_name in args.files:
+        start = time.perf_counter()
+        job = submit_transfer(args.mentee, file_name, args.mentor, args.url, not args.no_wait, **options)
+        if args.no_wait:
+            print("%s: queued as job %s" % (file_name, job['id']))
+        else:
+            print("%s: %s in %.2f s%s" % (file_name, "saved" if job['success'] else "NOT saved",
+                                          time.perf_counter() - start, " - " + job['error'] if job['error'] else ""))
+
+####################### END OF PROGRAM #################################################
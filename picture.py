@@ -1,9 +1,40 @@
 from qiskit import QuantumRegister, ClassicalRegister, QuantumCircuit, Aer, transpile, assemble
 import PIL.Image as Image #NOTE: Pillow imported instead of PIL
-import io
 import os
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import shelve
+import logging
+import contextlib
+import tempfile
+import zlib
+import lzma
+import threading
+import time
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import urllib.parse
 from numpy.random import randint
 import numpy as np
+import scipy.sparse
+
+# simulator backends and transpiled circuit templates, cached by backend name (see get_backend/get_circuit_template)
+_BACKENDS = {}
+_CIRCUIT_TEMPLATES = {}
+
+# random number generator of the NumPy engine (see sample_neqr_memory)
+_NUMPY_RNG = np.random.default_rng()
+
+# log-likelihood matrices of the decoder, cached by noise tolerance and position qubits (see decode_histograms)
+_LIKELIHOODS = {}
+
+# number of 8-bit intensities at each Hamming distance 0-8 of a given intensity
+_BINOMIAL_8 = np.array([1, 8, 28, 56, 70, 56, 28, 8, 1])
 
 ######################### FUNCTIONS ######################################################
 
@@ -41,211 +72,829 @@ def bob_gates(qc, qubit, crz, crx):
     qc.x(qubit).c_if(crx, 1)  # Only apply gates when the classical registers are in the state '1'
     qc.z(qubit).c_if(crz, 1)
 
-def run_circuits(values):
-    """Initialize an NEQR quantum circuit to represent the 2x2 image
-    this function receives in the form of intensity bytes for each pixel.
-
-    Then, reuse 2 qubits to form bell-pairs to teleport each of the 10 NEQR qubits from
-    alice to bob, one by one.
-
-    Simulate this quantum circuit with the Aer simulator, and recover the measurement outcomes
-    for the 8-bit intensity for each pixel position, encoded in 2 bits.
-    :param 4 8-bit intensity values for each pixel 00/01/10/11 in this image subset
-    :return the now-teleported 2x2 image in the form of a length 4 array of bytes"""
-
-    # Initialize the quantum circuit representation for 4 pixels of the image.
+def bob_controlled_gates(qc, qubit, a, b):
+    """Deferred measurement version of bob_gates: rather than alice measuring qubits a and b and sending the
+    results, Bob's corrections are controlled by the qubits themselves, which can then be measured at the end of
+    the circuit (or not at all)."""
+    qc.cx(b, qubit)  # X gate controlled by alice's bell-pair half, which would be measured into crx
+    qc.cz(a, qubit)  # Z gate controlled by the qubit being teleported, which would be measured into crz
 
-    # This process is split into groups of 4 pixels to simulate fewer qubits at a time,
-    # in order to conserve computing resources and to provide the user of progress
-    # updates on the teleportation. Only 2 qubits are needed for position this way.
+def create_image_circuit(position_qubits=2):
+    """Create an empty quantum circuit with the registers needed to represent an image subset of
+    2^position_qubits pixels with NEQR, and to teleport it qubit by qubit.
+    :param position_qubits: number of pixel position qubits, 2 for a 2x2 image subset
+    :return: the empty quantum circuit, and its classical registers cr, crz and crx"""
 
-    # Pixel position qubits (4 positions represented as 00, 01, 10, and 11)
-    idx = QuantumRegister(2, 'idx')
+    # Pixel position qubits (4 positions represented as 00, 01, 10, and 11 for 2 position qubits)
+    idx = QuantumRegister(position_qubits, 'idx')
 
     # pixel intensity qubits (grayscale, requires 8 bits for 1 to 255)
     intensity = QuantumRegister(8,'intensity')
 
-    # bell pair qubits for teleporting each of the 10 NEQR qubits above
+    # bell pair qubits for teleporting each of the NEQR qubits above
     teleport = QuantumRegister(2,'teleport')
 
     # classical registers for measurements to be recorded in during simulation of quantum circuit
-    cr = ClassicalRegister(10, 'cr') # -> for 10 NEQR qubits
+    cr = ClassicalRegister(8+position_qubits, 'cr') # -> for the 8+position_qubits NEQR qubits
     crz = ClassicalRegister(1, name="crz") # -> for 1 teleportation qubit
     crx = ClassicalRegister(1, name="crx") # -> for 1 more teleportation qubit
 
-    # create the quantum circuit of the 4 pixel image. 3 quantum registers, 3 classical.
+    # create the quantum circuit of the image subset. 3 quantum registers, 3 classical.
     qc_image = QuantumCircuit(intensity, idx, teleport, cr, crx, crz)
 
-    # get the total number of qubits in this circuit
-    num_qubits = qc_image.num_qubits
+    return qc_image, cr, crz, crx
 
-    # Use hadamard gate on pixel position qubits to induce superposition, which will allow us
-    # to take advantage of every position in the 2x2 image (subset) at once.
-    qc_image.h(8)
-    qc_image.h(9)
+def encode_positions(qc_image):
+    """Use hadamard gates on the pixel position qubits to induce superposition, which will allow us
+    to take advantage of every position in the image subset at once."""
+    for qubit in range(8, qc_image.num_qubits-2):
+        qc_image.h(qubit)
 
     # barriers are used to delineate sections of the quantum circuit
     qc_image.barrier()
 
-    # The 1st pixel, 00, is encoded into the image circuit.
-    # Make the forthcoming CNOT gate(s) trigger for 00 pixel by wrapping with X gates on pixel qubits.
-    # This X gate wrapping is undertaken for each pixel, except for position 11 (functioning as a default)
-    qc_image.x(qc_image.num_qubits-3)
-    qc_image.x(qc_image.num_qubits-4)
-
-    # Add CNOT gate to each targeted intensity qubit in the byte with qubit controls on pixel qubits (2).
-    # Bit values are reversed so that the measurements are in the order one expects.
-    for idx, px_value in enumerate((values[0])[::-1]):
-        if (px_value == '1'):
-            qc_image.ccx(num_qubits-3, num_qubits-4, idx)
+def encode_intensities(qc_image, values):
+    """Encode the 8-bit intensity of each pixel into the image circuit with (multi-controlled) CNOT gates
+    controlled by the pixel position qubits.
+    :param qc_image: image circuit, with its position qubits already in superposition
+    :param values: 8-bit intensity (0-255) of each pixel, e.g. 00/01/10/11 for 4 pixels"""
 
-    # end of the X gate wrapping for pixel 00, resetting the first 2
-    qc_image.x(qc_image.num_qubits-3)
-    qc_image.x(qc_image.num_qubits-4)
+    # pixel position qubits, following the 8 intensity qubits and followed by the 2 teleportation qubits
+    position = list(range(8, qc_image.num_qubits-2))
 
-    qc_image.barrier()
+    for pixel, value in enumerate(values):
 
-    # The 2nd pixel, 01, is encoded into the image circuit.
-    # For this pixel, the control must be a combination of 0 and 1 to trigger the CNOT gate, hence the X gates.
-    qc_image.x(qc_image.num_qubits-3)
+        # Make the forthcoming CNOT gate(s) trigger for this pixel by wrapping the position qubits that are 0 in
+        # the pixel's position with X gates. The last pixel (all 1s) functions as a default and needs no wrapping.
+        # Position bit j (counting from the right) is held by position qubit j.
+        wrapped = [qubit for j, qubit in enumerate(position) if not (pixel >> j) & 1]
+        for qubit in wrapped:
+            qc_image.x(qubit)
 
-    # Add CNOT gate to each targeted intensity qubit in the byte with qubit controls on pixel qubits (2)
-    for idx, px_value in enumerate((values[1])[::-1]):
-        if(px_value=='1'):
-            qc_image.ccx(num_qubits-3, num_qubits-4, idx)
+        # Add CNOT gate to each targeted intensity qubit in the byte with qubit controls on pixel qubits.
+        # Intensity qubit idx holds bit idx (counting from the right) so that the measurements are in the order one
+        # expects. With 2 position qubits, mcx adds the same ccx gates as a Toffoli.
+        for idx in range(8):
+            if ((value >> idx) & 1):
+                qc_image.mcx(position, idx)
 
-    # Finish X gate wrap of pixel 01, resetting the first one
-    qc_image.x(num_qubits-3)
+        # end of the X gate wrapping for this pixel, resetting the position qubits
+        for qubit in wrapped:
+            qc_image.x(qubit)
 
-    qc_image.barrier()
-
-    # The 3rd pixel, 10, is encoded into the image circuit
-    # As with pixel 2, we want the CNOT gate to trigger when control is a combination of 1 and 0.
-    qc_image.x(num_qubits-4)
-
-    # Add CNOT gate to each targeted intensity qubit in the byte with qubit controls on pixel qubits (2)
-    for idx, px_value in enumerate((values[2])[::-1]):
-        if(px_value=='1'):
-            qc_image.ccx(num_qubits-3, num_qubits-4, idx)
-
-    # Finish X gate wrap of pixel 10, resetting the first one
-    qc_image.x(num_qubits-4)
-
-    qc_image.barrier()
-
-    # The 4th pixel, 11, is encoded into the image circuit. No X gate wrapping needed for 11.
-    # Add CNOT gate to each targeted intensity qubit in the byte with qubit controls on pixel qubits (2)
-    for idx, px_value in enumerate((values[3])[::-1]):
-        if(px_value=='1'):
-            qc_image.ccx(num_qubits-3,num_qubits-4, idx)
+        qc_image.barrier()
 
-    qc_image.barrier()
+def teleport_image(qc_image, cr, crz, crx):
+    """Utilize the 2 teleportation qubits to teleport each NEQR qubit from alice to bob, and measure
+    the teleported qubit into cr.
+    This process is repeated for each of the NEQR qubits (8 intensity, 2 pixel position for 4 pixels)
+    with the teleportation qubits resetting each time in order to be reused."""
 
-    #########################################################################################
-    # At this stage, the NEQR circuit representation for the 2x2 image subset has been built.
-    #########################################################################################
+    # the 2 teleportation qubits follow the NEQR qubits
+    alice = qc_image.num_qubits-2
+    bob = qc_image.num_qubits-1
 
-    # Next, we utilize the 2 teleportation qubits to teleport each NEQR qubit from alice to bob.
-    # This process is repeated for each of the 10 NEQR qubits (8 intensity, 2 pixel position)
-    # with the teleportation qubits resetting each time in order to be reused.
-    for i in range(0,num_qubits-2):
+    for i in range(0,qc_image.num_qubits-2):
 
         # First, a bell pair is created by a third party (let's call them Eve!).
         # One of each of these entangled qubits is given to alice and bob.
-        create_bell_pair(qc_image, 10, 11)
+        create_bell_pair(qc_image, alice, bob)
 
         qc_image.barrier()
 
         # Alice applies a CNOT gate to her bell pair qubit, controlled by the
         # qubit state we want to teleport to bob. H gate is applied to the latter qubit as well.
-        alice_gates(qc_image, i, 10)
+        alice_gates(qc_image, i, alice)
 
         # Alice measures the teleportation qubit (bell-pair half) that she owns, and the qubit
         # state she wants to send to Bob. These results are stored in classical bits and sent to Bob.
-        measure_and_send(qc_image, i, 10, crz, crx)
+        measure_and_send(qc_image, i, alice, crz, crx)
 
         qc_image.barrier()
 
         # Lastly, Bob chooses which gates to apply to his bell-pair half (teleportation qubit) based on
         # the classical bits he receives from Alice.
-        bob_gates(qc_image, 11, crz, crx)
+        bob_gates(qc_image, bob, crz, crx)
 
         # Measure bob's qubit (which has successfully taken on the state of alice's intended qubit to send).
-        # In this case, it will contain information about the 8-bit intensity of each of 4 pixels (2 bits).
-        qc_image.measure(11, cr[i])
+        # In this case, it will contain information about the 8-bit intensity of each pixel, or its position.
+        qc_image.measure(bob, cr[i])
 
         # Reset the bell-pair qubits created by Eve so they can be reused to continue teleporting
-        # the entire NEQR represented image susbet (2x2). 10 qubits in total will be teleported.
-        qc_image.reset(qc_image.qubits[10:12])
+        # the entire NEQR represented image susbet.
+        qc_image.reset([alice, bob])
 
         qc_image.barrier()
 
-    #########################################################################################
-    # The full NEQR and teleportation circuit has been built. Time to simulate it:
-    #########################################################################################
+def teleport_image_deferred(qc_image, cr, crz, crx):
+    """Compile the same teleportation as teleport_image without any mid-circuit measurement, classical condition
+    or reset, so that a simulator can sample every shot from a single final state.
+
+    Bob's corrections are controlled by alice's qubits (bob_controlled_gates), after which both of alice's qubits are
+    left in the |+> state, unentangled from the rest, and returned to |0> with hadamard gates instead of being reset.
+    Rather than moving each teleported state back, the qubits are remapped: the NEQR qubit that was just teleported
+    becomes Bob's fresh qubit for the next round. Every teleported qubit is measured into cr at the end, and alice's
+    qubits of the last round into crz/crx, which gives the same measurement outcomes as teleport_image."""
+
+    # the 2 teleportation qubits follow the NEQR qubits
+    neqr_qubits = qc_image.num_qubits-2
+    alice = qc_image.num_qubits-2
+    bob = qc_image.num_qubits-1
 
-    # Run the NEQR image representation and subsequent teleportation and measurements with the Aer simulator
-    # 20 shots failed often. 30 failed rarely. 40 should be safe, and not too time-consuming.
-    shot_count = 40
-    aer_sim = Aer.get_backend('aer_simulator')
-    t_qc_image = transpile(qc_image, aer_sim)
-    qobj = assemble(t_qc_image, shots=shot_count)
-    job_neqr = aer_sim.run(qobj)
-    result_neqr = job_neqr.result()
+    # qubit holding the teleported state of each NEQR qubit
+    destinations = []
 
-    # dictionary with all measurement results for the total 12 classical register bits
-    counts_neqr = result_neqr.get_counts()
+    for i in range(0, neqr_qubits):
 
-    # measurement counts for each intensity, each likely mapping onto 1 of 4 pixel coordinates: [00, 01, 10, 11]
-    counts=[0,0,0,0]
+        # Bell pair shared by alice and bob, and alice's gates, as in teleport_image
+        create_bell_pair(qc_image, alice, bob)
 
-    # Check dictionary keys for the 4 unique measurement outcomes (excluding the crz/crx classical registers).
-    # These 4 unique measurement outcomes, roughly equal in their prevalence, assign pixel location with the
-    # first 2 bits, and intensity with the following 8 bits. The first 2 bits in these measurements may be
-    # excluded from our analysis, as they are a relic of the teleportation qubit measurements.
-    for key in counts_neqr.keys():
+        qc_image.barrier()
+
+        alice_gates(qc_image, i, alice)
+
+        qc_image.barrier()
+
+        # Bob's corrections, after which bob's qubit holds the state of NEQR qubit i
+        bob_controlled_gates(qc_image, bob, i, alice)
+        destinations.append(bob)
 
-        if (key[4:]=='00'+values[0]):
-            counts[0]=counts[0]+counts_neqr[key]
+        if (i < neqr_qubits-1):
+            # Return alice's qubits to |0>. Qubit i is no longer needed, so it becomes bob's qubit in the next round.
+            qc_image.h([i, alice])
+            bob = i
 
-        elif (key[4:]=='01'+values[1]):
-            counts[1]=counts[1]+counts_neqr[key]
+        qc_image.barrier()
 
-        elif (key[4:] == '10'+values[2]):
-            counts[2] = counts[2] + counts_neqr[key]
+    # alice's qubits of the last round are measured into crz/crx as teleport_image leaves them (uniformly random),
+    # followed by the teleported qubits
+    qc_image.measure(neqr_qubits-1, crz)
+    qc_image.measure(alice, crx)
+    for i, qubit in enumerate(destinations):
+        qc_image.measure(qubit, cr[i])
+
+# ways of compiling the teleportation part of the image circuit, see build_image_circuit
+TELEPORT_MODES = {'dynamic': teleport_image, 'deferred': teleport_image_deferred}
+
+def get_position_qubits(values):
+    """Get the number of pixel position qubits needed to encode values, which must hold 2^k pixels (k >= 1)."""
+    position_qubits = len(values).bit_length()-1
+    if (position_qubits < 1 or len(values) != 2**position_qubits):
+        raise ValueError("Image subsets must hold 2^k pixels (k >= 1), not "+str(len(values)))
+    return position_qubits
+
+def build_image_circuit(values, teleport_mode='dynamic'):
+    """Build the full NEQR and teleportation circuit for an image subset from scratch.
+    run_circuits uses the cached template from get_circuit_template instead, this is kept as the
+    reference construction (and for benchmarking the template against).
+    :param values: 8-bit intensity (0-255) of each of the 2^k pixels, e.g. 00/01/10/11 for 4 pixels
+    :param teleport_mode: 'dynamic' to teleport with mid-circuit measurements, classically conditioned corrections
+        and resets (teleport_image), or 'deferred' to defer every measurement to the end (teleport_image_deferred)
+    :return: the untranspiled image circuit"""
+    qc_image, cr, crz, crx = create_image_circuit(get_position_qubits(values))
+    encode_positions(qc_image)
+    encode_intensities(qc_image, values)
+    TELEPORT_MODES[teleport_mode](qc_image, cr, crz, crx)
+    return qc_image
+
+def circuit_stats(qc):
+    """:return: dictionary of the number of gates (excluding barriers and measurements), measurements, and depth of
+    a circuit"""
+    ops = qc.count_ops()
+    return {'gates': sum(n for op, n in ops.items() if op not in ('barrier', 'measure')),
+            'measurements': ops.get('measure', 0), 'depth': qc.depth()}
+
+def get_backend(name='aer_simulator'):
+    """Get the simulator backend called name, creating it only the first time it is requested."""
+    if name not in _BACKENDS:
+        _BACKENDS[name] = Aer.get_backend(name)
+    return _BACKENDS[name]
+
+def get_circuit_template(backend, position_qubits=2, teleport_mode='dynamic'):
+    """Get the fixed skeleton of the image circuit for backend, which is the same for every image subset of the
+    same size: the position hadamards before the intensity gates (head), and the bell-pair/teleport/reset section
+    with its measurements after them (tail), compiled with teleport_mode (see build_image_circuit). Both are built
+    and transpiled only once per backend, block size and teleport mode.
+    :return: head and tail circuits, and whether the intensity gates can be spliced in without transpiling"""
+    name = (backend.name(), position_qubits, teleport_mode)
+    if name not in _CIRCUIT_TEMPLATES:
+        head, cr, crz, crx = create_image_circuit(position_qubits)
+        encode_positions(head)
+        tail = head.copy_empty_like()
+        TELEPORT_MODES[teleport_mode](tail, cr, crz, crx)
+
+        # The intensity gates are only x and (multi-controlled) CNOT gates. If the backend supports them natively
+        # (as the Aer simulator does) they need no transpiling, and can be spliced into the transpiled template as is.
+        basis_gates = backend.configuration().basis_gates
+        controlled_x = {1: 'cx', 2: 'ccx'}.get(position_qubits, 'mcx')
+        native = 'x' in basis_gates and controlled_x in basis_gates
+
+        _CIRCUIT_TEMPLATES[name] = (transpile(head, backend), transpile(tail, backend), native)
+    return _CIRCUIT_TEMPLATES[name]
+
+def build_templated_circuit(values, backend, teleport_mode='dynamic'):
+    """Splice the intensity gates for an image subset into the cached circuit template of backend.
+    :param values: 8-bit intensity (0-255) of each of the 2^k pixels, e.g. 00/01/10/11 for 4 pixels
+    :param teleport_mode: how the teleportation is compiled, see build_image_circuit
+    :return: the image circuit, ready to be run on backend"""
+    head, tail, native = get_circuit_template(backend, get_position_qubits(values), teleport_mode)
+    qc_image = head.copy()
+    encode_intensities(qc_image, values)
+    if (not native):
+        qc_image = transpile(qc_image, backend)
+    qc_image.compose(tail, inplace=True)
+    return qc_image
+
+def shots_for_block_size(position_qubits, failure_rate=5e-5):
+    """Number of shots needed to measure every pixel of an image subset of 2^position_qubits pixels at least
+    once, with a probability of missing one of at most failure_rate (using the union bound over pixels).
+    The default failure_rate gives the 40 shots used for 4 pixels."""
+    pixels = 2**position_qubits
+    return int(np.ceil(np.log(pixels/failure_rate) / -np.log1p(-1/pixels)))
+
+def plan_block_size(qubit_budget, shot_budget, failure_rate=5e-5):
+    """
+    Pick the number of pixel position qubits k for image subsets of 2^k pixels. Larger subsets need wider circuits
+    and more shots each, but far fewer simulator jobs for the same file, so the largest k that fits both budgets
+    is chosen.
+    :param qubit_budget: maximum number of qubits per circuit (8 intensity + k position + 2 teleportation)
+    :param shot_budget: maximum number of shots per circuit
+    :param failure_rate: accepted probability of a pixel not being measured, see shots_for_block_size
+    :return: the number of position qubits k
+    """
+    position_qubits = 0
+    while (8+(position_qubits+1)+2 <= qubit_budget
+           and shots_for_block_size(position_qubits+1, failure_rate) <= shot_budget):
+        position_qubits += 1
+    if (position_qubits < 1):
+        raise ValueError("A qubit budget of at least 11 and a shot budget of at least "
+                         + str(shots_for_block_size(1, failure_rate)) + " are needed")
+    return position_qubits
+
+def histogram_memory(memory, position_qubits):
+    """Count the outcomes of each pixel position in the shot memory of a batch of image circuits.
+    :param memory: integer array of shape (blocks, shots), the cr register measured by each shot (the pixel position
+        in the high bits followed by its 8-bit intensity). Higher bits, such as crz/crx, are ignored.
+    :param position_qubits: number of pixel position qubits k
+    :return: integer array of shape (blocks, 2^k, 256), how many times each intensity was measured for each pixel"""
+    num_blocks = memory.shape[0]
+    size = 2**(position_qubits+8)
+
+    # a single bincount over every block, offsetting each block's outcomes by its index
+    flat = (np.arange(num_blocks)[:, None]*size + (memory & (size-1))).ravel()
+    return np.bincount(flat, minlength=num_blocks*size).reshape(num_blocks, 2**position_qubits, 256)
+
+def _likelihood_matrix(tolerance, position_qubits):
+    """Log-likelihood of measuring each intensity x given each encoded intensity v, for a measurement of the pixel
+    whose 8 intensity bits are each flipped with probability tolerance. A shot of another pixel can also land on
+    this pixel if its position bits are flipped, which is accounted for as a uniformly random intensity.
+    :return: array L where L[x, v] is the log-likelihood of measuring x given v"""
+    key = (tolerance, position_qubits)
+    if key not in _LIKELIHOODS:
+        # floor the flip probability, so that the ideal case (tolerance 0) still decodes the most likely intensity
+        # instead of ruling out every intensity whenever a single unexpected outcome is measured
+        flip = min(max(tolerance, 1e-6), 0.5)
+        misplaced = 1 - (1-flip)**position_qubits
+        distance = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None] ^ np.arange(256, dtype=np.uint8), axis=-1)
+        distance = distance.reshape(256, 256, 8).sum(axis=-1)
+        likelihood = (1-misplaced) * flip**distance * (1-flip)**(8-distance) + misplaced/256
+        _LIKELIHOODS[key] = np.log(likelihood)
+    return _LIKELIHOODS[key]
+
+def decode_histograms(histograms, tolerance=0.0):
+    """Pick the maximum-likelihood intensity of each pixel from its measured intensities.
+    :param histograms: integer array of shape (blocks, 2^k, 256), see histogram_memory
+    :param tolerance: probability of each measured bit being flipped by noise, which the decoder tolerates
+    :return: array of the decoded intensities, of shape (blocks, 2^k), and array of the confidence in each of them:
+        the posterior probability of the decoded intensity (with every intensity equally likely a priori). A pixel
+        that was never measured has a confidence of 1/256."""
+    position_qubits = histograms.shape[1].bit_length()-1
+    likelihood = _likelihood_matrix(tolerance, position_qubits)
+    rows = histograms.reshape(-1, 256)
+    best = np.zeros(len(rows), dtype=np.int64)
+    confidence = np.full(len(rows), 1/256)
+
+    # Without noise, every shot of a pixel measures its intensity, so most pixels were only measured as a single
+    # intensity x (n times). Its log-likelihood given v is then n*l(d), which only depends on the Hamming distance d
+    # of x and v, so x is decoded with confidence 1/sum_d C(8,d)*exp(n*(l(d)-l(0))), without a product with L.
+    totals = rows.sum(axis=1)
+    peaks = rows.argmax(axis=1)
+    peak_counts = np.take_along_axis(rows, peaks[:, None], axis=1)[:, 0]
+    single = np.flatnonzero((totals > 0) & (peak_counts == totals))
+    best[single] = peaks[single]
+    by_distance = likelihood[0, (1 << np.arange(9)) - 1]
+    confidence[single] = 1/(np.exp(totals[single, None]*(by_distance - by_distance[0])) @ _BINOMIAL_8)
+
+    # log-likelihood of every intensity for each of the other pixels, as a product with the likelihood matrix. Each
+    # pixel is only measured as a few distinct intensities, so the histograms are multiplied as a sparse matrix.
+    mixed = np.flatnonzero(totals > peak_counts)
+    if len(mixed):
+        loglikelihood = scipy.sparse.csr_matrix(rows[mixed]) @ likelihood
+        best[mixed] = loglikelihood.argmax(axis=-1)
+        peak = np.take_along_axis(loglikelihood, best[mixed, None], axis=-1)
+        confidence[mixed] = 1/np.exp(loglikelihood - peak).sum(axis=-1)
+    return best.reshape(histograms.shape[:2]), confidence.reshape(histograms.shape[:2])
+
+def sample_neqr_memory(blocks, shot_count, noise=0.0, rng=None):
+    """
+    Purpose-built NumPy engine for the NEQR and teleportation circuits built by build_image_circuit, which samples
+    the measurement outcomes of a whole batch of image circuits at once instead of simulating each of them.
+
+    Every teleportation round of these circuits is ideal, so the final measurements of the NEQR qubits follow the
+    NEQR state itself: a uniformly random pixel position, with that pixel's intensity. Alice's measurements of the
+    last round (crz/crx) are uniformly random bits.
+    :param blocks: list of 2^k 8-bit intensities for each pixel in each image subset, all of the same size
+    :param shot_count: number of shots sampled for each image circuit
+    :param noise: probability of each measured NEQR bit being flipped, independently (0 for the ideal circuit)
+    :param rng: numpy random Generator, the module's default generator if None
+    :return: integer array of shape (blocks, shots), the outcome of every shot with crz and crx as its most
+        significant bits (as Aer orders the registers), followed by the cr register
+    """
+    if (rng is None):
+        rng = _NUMPY_RNG
+    position_qubits = get_position_qubits(blocks[0])
+    cr_bits = 8+position_qubits
+
+    # intensities of every pixel of every block, as an array of shape (blocks, pixels)
+    intensities = np.array(blocks, dtype=np.int64)
+
+    # sample a pixel position for every shot of every block, and look up its intensity: shape (blocks, shots)
+    positions = rng.integers(0, 2**position_qubits, size=(len(blocks), shot_count))
+    cr = (positions << 8) | np.take_along_axis(intensities, positions, axis=1)
+
+    # flip each of the measured NEQR bits with probability noise
+    if (noise > 0):
+        flips = rng.random((len(blocks), shot_count, cr_bits)) < noise
+        cr ^= (flips << np.arange(cr_bits)).sum(axis=2)
+
+    # crz and crx, prepended to the cr measurements as the most significant bits
+    return (rng.integers(0, 4, size=(len(blocks), shot_count)) << cr_bits) | cr
+
+def sample_neqr_counts(blocks, shot_count, noise=0.0, rng=None):
+    """Sample the measurement outcomes of a batch of image circuits with sample_neqr_memory, and count them.
+    :return: list of dictionaries of measurement counts for each block, in the same format as Aer's get_counts"""
+    cr_bits = 8+get_position_qubits(blocks[0])
+    counts_list = []
+    for block_outcomes in sample_neqr_memory(blocks, shot_count, noise, rng):
+        keys, counts = np.unique(block_outcomes, return_counts=True)
+        counts_list.append({
+            str(key >> (cr_bits+1)) + ' ' + str((key >> cr_bits) & 1) + ' ' + format(key & (2**cr_bits-1), '0'+str(cr_bits)+'b'):
+            int(count) for key, count in zip(keys, counts)})
+    return counts_list
+
+def run_circuits_batch(blocks, batch_size=64, backend='aer_simulator', noise=0.0, initial_shots=None, max_shots=None,
+                       tolerance=None, min_confidence=0.99, shots_used=None, confidences=None, metrics=None,
+                       teleport_mode='dynamic'):
+    """Initialize an NEQR quantum circuit to represent each of the image subsets
+    this function receives in the form of intensity bytes for each pixel.
 
-        elif (key[4:]=='11'+values[3]):
-            counts[3]=counts[3]+counts_neqr[key]
+    Then, reuse 2 qubits to form bell-pairs to teleport each of the NEQR qubits from
+    alice to bob, one by one.
+
+    Simulate these quantum circuits with the Aer simulator, batch_size circuits per job, and decode the most likely
+    8-bit intensity for each pixel position from the measurement outcomes of every shot (see decode_histograms).
+
+    Shots are allocated adaptively: each circuit is first simulated with initial_shots, and only the circuits with
+    a pixel decoded with less than min_confidence are simulated again, doubling their shots each round, until every
+    pixel has been decoded confidently or max_shots is reached.
+    :param blocks: list of 2^k 8-bit intensity values for each pixel (00/01/10/11 for k=2) in each image subset,
+        all with the same number of pixels
+    :param batch_size: number of image circuits simulated together in one Aer job
+    :param backend: name of the simulator backend, an Aer backend such as 'aer_simulator', or 'numpy' to
+        sample the circuits' outcomes with the purpose-built NumPy engine (see sample_neqr_memory)
+    :param noise: bit flip probability of the measurements, only supported by the 'numpy' backend
+    :param initial_shots: shots of the first round, 2^k*(k+1) by default (12 for 4 pixels)
+    :param max_shots: maximum total shots per circuit, 4 times shots_for_block_size by default (160 for 4 pixels)
+    :param tolerance: bit flip probability tolerated by the decoder, noise by default
+    :param min_confidence: confidence each pixel must be decoded with before its circuit stops being sampled
+    :param shots_used: optional list, the total shots spent on each block are appended to it
+    :param confidences: optional list, the confidence in each decoded pixel of each block is appended to it
+    :param metrics: optional Metrics, timing the transpile, build, simulation and decode stages
+    :param teleport_mode: how the teleportation is compiled for Aer backends, 'dynamic' or 'deferred' (which Aer
+        simulates far faster, see build_image_circuit)
+    :return: the now-teleported image subsets, each in the form of an array of bytes, in the order of blocks"""
+
+    # This process is split into groups of 2^k pixels (4 by default) to simulate fewer qubits at a time,
+    # in order to conserve computing resources and to provide the user of progress
+    # updates on the teleportation. Only k qubits are needed for position this way.
+    if (not blocks):
+        return []
+
+    # A fixed 40 shots for 4 pixels rarely (but sometimes) failed to measure every pixel, while most circuits
+    # need far fewer. Each pixel is measured with probability 1/2^k per shot, so 2^k*(k+1) shots measure
+    # every pixel most of the time, and the few circuits that miss one are simulated again.
+    position_qubits = get_position_qubits(blocks[0])
+    if (initial_shots is None):
+        initial_shots = 2**position_qubits*(position_qubits+1)
+    if (max_shots is None):
+        max_shots = 4*shots_for_block_size(position_qubits)
+    if (tolerance is None):
+        tolerance = noise
 
-    # 4 encoded then teleported bytes, to be returned, which are to be deduced from counts of measurement
-    # simulations of the quantum circuit representation of the 2x2 image.
     processed = []
+    for first in range(0, len(blocks), batch_size):
+        batch = blocks[first:first+batch_size]
+
+        if (backend != 'numpy'):
+            if (noise > 0):
+                raise ValueError("noise is only supported by the 'numpy' backend")
+            aer_sim = get_backend(backend)
+            with _timer(metrics, 'transpile'):
+                get_circuit_template(aer_sim, position_qubits, teleport_mode)
+
+            # Only the intensity gates change from one image subset to the next, so they are spliced into
+            # a circuit template holding the rest of the NEQR and teleportation circuit, which is transpiled once.
+            with _timer(metrics, 'build'):
+                t_qc_images = [build_templated_circuit(values, aer_sim, teleport_mode) for values in batch]
+
+        # measured intensities of each pixel, shots so far, and decoded intensities and their confidence for each
+        # block, and the blocks which still need sampling
+        histograms = np.zeros((len(batch), 2**position_qubits, 256), dtype=np.int64)
+        shots_batch = np.zeros(len(batch), dtype=np.int64)
+        decoded = np.zeros((len(batch), 2**position_qubits), dtype=np.int64)
+        confidence = np.zeros((len(batch), 2**position_qubits))
+        pending = np.arange(len(batch))
+        shot_count = min(initial_shots, max_shots)
+
+        while len(pending):
+            with _timer(metrics, 'simulation'):
+                if (backend == 'numpy'):
+                    # The outcomes of the pending blocks are sampled at once as arrays, without building any circuit.
+                    memory = sample_neqr_memory([batch[i] for i in pending], shot_count, noise)
+                else:
+                    # The pending blocks are submitted as a single multi-experiment job, so the per-job overhead is
+                    # only paid once per round, and Aer is free to simulate the experiments in parallel. The outcome
+                    # of every shot is kept in its memory (as hexadecimal integers).
+                    qobj = assemble([t_qc_images[i] for i in pending], shots=shot_count, memory=True)
+                    result_neqr = aer_sim.run(qobj, max_parallel_experiments=0).result()
+                    memory = np.array([[int(outcome, 16) for outcome in result_neqr.data(j)['memory']]
+                                       for j in range(len(pending))], dtype=np.int64)
+
+            with _timer(metrics, 'decode'):
+                histograms[pending] += histogram_memory(memory, position_qubits)
+                shots_batch[pending] += shot_count
+                decoded[pending], confidence[pending] = decode_histograms(histograms[pending], tolerance)
+
+                # only the blocks with a pixel that was not decoded confidently are simulated again, with double the
+                # shots
+                pending = pending[(confidence[pending].min(axis=1) < min_confidence)
+                                  & (shots_batch[pending] < max_shots)]
+            # (every pending block has been sampled the same number of shots so far)
+            if len(pending):
+                shot_count = int(min(shots_batch[pending[0]], max_shots-shots_batch[pending[0]]))
+
+        # If insufficient shots are used, one may not measure at least one pixel at all, which cannot be decoded.
+        # This only happens when max_shots is reached.
+        if (histograms.sum(axis=2).min() == 0):
+            raise RuntimeError("insufficient shots ("+str(max_shots)+") in circuit simulation to check all expected "
+                               "pixel intensities from measurements. Please try again with a higher max_shots.")
+
+        # In the presence of noise, some pixels may still be decoded with low confidence after max_shots, in which
+        # case their most likely intensity is returned, and the confidence can be checked by the caller.
+        processed.extend(decoded.tolist())
+        if (confidences is not None):
+            confidences.extend(confidence.tolist())
+        if (shots_used is not None):
+            shots_used.extend(shots_batch.tolist())
+        if (metrics is not None):
+            metrics.count('simulated_blocks', len(batch))
+            metrics.count('shots', int(shots_batch.sum()))
+            metrics.count('low_confidence_blocks', int((confidence.min(axis=1) < min_confidence).sum()))
 
-    # In this idealized simulation, we expect to have enough shots and low noise such that there are only
-    # 4 unique measurement outcomes, corresponding to the 8-bit intensity of each of 2-bit pixel positions.
-    if(sum(counts) != shot_count):
-        # Counts for the 4 unique/expected measurement outcomes must equal the overall simulation shot count.
-        # Otherwise, we have not accounted for every possible measurement of the simulated quantum circuit.
-        # This is only true in this idealized simulation.
-        print("ERROR: some measurement possibilities not accounted for in the count. Please check counts_neqr.")
-        print("EXITING...")
-        exit()
-    elif (counts[0]<=0 or counts[1]<=0 or counts[2]<=0 or counts[3]<=0):
-        # If insufficient shots are used during the Aer simulation, one may not measure at least one
-        print("ERROR: insufficient shots in circuit simulation to check all expected pixel intensities from measurements.")
-        print("Please try again with higher shot count. 100 shots is vanishingly unlikely to fail.")
-        print("EXITING...")
-        exit()
+    return processed
+
+def summarize_shots(shots_used):
+    """Summarize the shots spent on each block by run_circuits_batch (see its shots_used).
+    :return: dictionary with the number of blocks, total shots, and mean/max shots per block"""
+    return {'blocks': len(shots_used), 'shots': int(sum(shots_used)),
+            'mean_shots': float(np.mean(shots_used)) if shots_used else 0.0,
+            'max_shots': int(max(shots_used, default=0))}
+
+class Metrics:
+    """
+    Timers and counters of the stages of a transfer: bb84, encryption, transpile, build, simulation, decode,
+    decryption and write. Each timer accumulates the seconds spent in its stage and the number of times the stage ran,
+    and each counter a total (bytes, blocks, shots...). Stages can overlap in time, as BB84 runs in the background and
+    worker processes simulate in parallel, whose metrics are merged in with merge.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Context manager timing the code it wraps as a run of stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds, calls=1):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + calls
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """:return: the timers and counters as a dictionary of plain types (which can be pickled or saved as JSON)"""
+        return {'seconds': dict(self.seconds), 'calls': dict(self.calls), 'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        """Add the timers and counters of a snapshot (e.g. from a worker process) to these."""
+        for stage, seconds in snapshot['seconds'].items():
+            self.add_time(stage, seconds, snapshot['calls'][stage])
+        for name, n in snapshot['counters'].items():
+            self.count(name, n)
+
+def _timer(metrics, stage):
+    """Time a stage with metrics.timer, or do nothing if metrics is None."""
+    return metrics.timer(stage) if metrics is not None else contextlib.nullcontext()
+
+def format_summary(summary):
+    """Format the summary of a transfer (see send_file) as a human readable report.
+    :return: the lines of the report"""
+    wall = summary['wall_seconds']
+    lines = [summary['file'] + ": " + str(summary['counters'].get('bytes', 0)) + " bytes in " + str(wall)[0:5]
+             + " seconds (" + ("saved" if summary['success'] else "NOT saved") + ")"]
+    for stage, seconds in sorted(summary['seconds'].items(), key=lambda item: -item[1]):
+        lines.append("  %-24s %8.3f s %6.1f %% of wall time, %d runs"
+                     % (stage, seconds, 100*seconds/wall if wall else 0.0, summary['calls'][stage]))
+    for name, n in sorted(summary['counters'].items()):
+        lines.append("  %-24s %s" % (name, n))
+    return lines
+
+def print_sink(summary):
+    """Summary sink printing the report of format_summary."""
+    print("\n".join(format_summary(summary)))
+
+def log_sink(logger=None, level=logging.INFO):
+    """:return: summary sink writing the report of format_summary to logger (this module's by default)"""
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    def sink(summary):
+        for line in format_summary(summary):
+            logger.log(level, line)
+    return sink
+
+def json_sink(path):
+    """:return: summary sink appending each summary to the file at path, as one JSON object per line"""
+    def sink(summary):
+        with open(path, "a") as f:
+            f.write(json.dumps(summary) + "\n")
+    return sink
+
+def throttle_progress(callback, min_interval=0.5):
+    """Wrap a progress callback, called as callback(done, total), so that it is called at most once every
+    min_interval seconds. The final call (done == total) is always passed on.
+    :return: the throttled callback"""
+    last = [None]
+    def throttled(done, total):
+        now = time.perf_counter()
+        if done >= total or last[0] is None or now - last[0] >= min_interval:
+            last[0] = now
+            callback(done, total)
+    return throttled
+
+def print_progress(done, total):
+    """Progress callback printing the % completion of the teleportation."""
+    print("Image teleportation "+str(100*float(done)/float(total))[0:4]+" % completed")
+
+def run_circuits(values, backend='aer_simulator', teleport_mode='dynamic'):
+    """Teleport a single image subset. See run_circuits_batch.
+    :param 8-bit intensity values (0-255) for each pixel 00/01/10/11 in this image subset (or 2^k pixels in general)
+    :return the now-teleported image subset in the form of an array of bytes (0-255)"""
+    return run_circuits_batch([values], backend=backend, teleport_mode=teleport_mode)[0]
+
+def _init_worker(position_qubits=2, backend='aer_simulator', teleport_mode='dynamic'):
+    """Warm up a teleportation worker process: create its Aer backend and circuit template once, so that they
+    are reused by every chunk of blocks the worker teleports. Each worker simulates with a single thread, as the
+    parallelism comes from the worker processes themselves."""
+    if (backend == 'numpy'):
+        return
+    aer_sim = get_backend(backend)
+    aer_sim.set_options(max_parallel_threads=1)
+    get_circuit_template(aer_sim, position_qubits, teleport_mode)
+
+def _teleport_chunk(chunk, batch_size, backend, timed=False, noise=0.0, teleport_mode='dynamic', sampling=None):
+    """Teleport a chunk of blocks with run_circuits_batch (in a worker process, or this one).
+    :param timed: whether to collect the Metrics of the chunk
+    :param sampling: optional dictionary of the initial_shots, max_shots, tolerance and min_confidence of
+        run_circuits_batch
+    :return: the teleported blocks, the shots spent on each of them, and a snapshot of the metrics (or None)"""
+    shots_used = []
+    metrics = Metrics() if timed else None
+    if chunk:
+        processed = run_circuits_batch(chunk, batch_size, backend, noise, shots_used=shots_used, metrics=metrics,
+                                       teleport_mode=teleport_mode, **(sampling or {}))
     else:
-        # We have 4 unique measurement outcomes for the 10 NEQR qubits, which indicates statistical significance.
-        # In the absence of noise (and even noise/eavesdropping during the QKD phase), if there is only 1 unique
-        # intensity measurement outcome for each pixel position, we can assume the initial byte values have been
-        # 100% accurately encoded into the quantum circuit, teleported, and ultimately measured. In the presence of
-        # noise, this process would need to employ tolerances on the measurement counts, and more statistical analysis
-        # to determine the best intensity value for each pixel.
-        processed = [values[0],values[1],values[2],values[3]]
+        processed = []
+    return processed, shots_used, metrics.snapshot() if timed else None
 
-    return processed
+class BlockCache:
+    """
+    LRU cache of teleported blocks, keyed by the contents of each block and a fingerprint of the simulation settings
+    (backend, noise, shots). In the ideal simulation, the decoded result of a block only depends on these, so repeated
+    blocks (JPEG headers, flat image regions, padding) skip the simulator. Optionally backed by a shelve file on disk,
+    so cached blocks are kept across runs. Hits and misses are counted for stats().
+    """
+
+    def __init__(self, max_blocks=65536, path=None):
+        """
+        :param max_blocks: maximum number of blocks kept in memory, the least recently used are evicted first
+        :param path: optional path of a shelve file on disk, which keeps every cached block
+        """
+        self.max_blocks = max_blocks
+        self._blocks = collections.OrderedDict()
+        self._disk = shelve.open(path) if path is not None else None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(block, fingerprint):
+        """Key of a block (list of intensities) for the simulation settings described by fingerprint."""
+        return fingerprint + ':' + bytes(block).hex()
+
+    def get(self, key):
+        """:return: the teleported block cached under key, or None"""
+        if key in self._blocks:
+            self._blocks.move_to_end(key)
+            return self._blocks[key]
+        if self._disk is not None and key in self._disk:
+            value = self._disk[key]
+            self._remember(key, value)
+            return value
+        return None
+
+    def put(self, key, value):
+        """Cache the teleported block value under key."""
+        self._remember(key, value)
+        if self._disk is not None:
+            self._disk[key] = value
+
+    def _remember(self, key, value):
+        self._blocks[key] = value
+        self._blocks.move_to_end(key)
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+    def stats(self):
+        """:return: dictionary of hits, misses, hit rate and number of blocks in memory"""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits/lookups if lookups else 0.0,
+                'size': len(self._blocks)}
+
+    def close(self):
+        """Close the file on disk, if any."""
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+def _cache_fingerprint(backend, noise, initial_shots=None, max_shots=None, tolerance=None, min_confidence=0.99):
+    """Fingerprint of the simulation settings that teleported blocks depend on besides their contents, which is part
+    of their keys in a BlockCache: the backend, the noise, and the shots and decoder settings of run_circuits_batch
+    (None standing for their defaults, which only depend on the block size)."""
+    return "%s/%s/shots=%s-%s/tolerance=%s/confidence=%s" % (backend, noise, initial_shots, max_shots, tolerance,
+                                                              min_confidence)
+
+def _lookup_chunk(chunk, cache, fingerprint):
+    """Look the blocks of a chunk up in the cache. Blocks repeated within the chunk are only teleported once, and
+    counted as hits after the first.
+    :return: the keys of the blocks, the cached teleported blocks (None where missing), and the keys and blocks
+    which are missing and need teleporting"""
+    if cache is None:
+        return None, [None]*len(chunk), None, chunk
+    keys = [BlockCache.key(block, fingerprint) for block in chunk]
+    cached = []
+    missing = {}
+    for key, block in zip(keys, chunk):
+        value = cache.get(key)
+        cached.append(value)
+        if value is None and key not in missing:
+            missing[key] = block
+            cache.misses += 1
+        else:
+            cache.hits += 1
+    return keys, cached, list(missing.keys()), list(missing.values())
+
+def _fill_chunk(keys, cached, missing_keys, processed, cache):
+    """Combine the cached and newly teleported blocks of a chunk, and cache the latter.
+    :return: the teleported blocks of the chunk, in order"""
+    if cache is None:
+        return processed
+    teleported = dict(zip(missing_keys, processed))
+    for key, value in teleported.items():
+        cache.put(key, value)
+    return [value if value is not None else teleported[key] for key, value in zip(keys, cached)]
+
+def _chunks(blocks, chunk_size):
+    """Split an iterable of blocks into lists of up to chunk_size blocks."""
+    blocks = iter(blocks)
+    chunk = list(itertools.islice(blocks, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(blocks, chunk_size))
+
+def teleport_blocks(blocks, batch_size=64, workers=1, chunk_size=None, progress=None, total=None,
+                    backend='aer_simulator', shots_used=None, cache=None, metrics=None, noise=0.0,
+                    teleport_mode='dynamic', initial_shots=None, max_shots=None, tolerance=None, min_confidence=0.99):
+    """Teleport groups of 2^k bytes with run_circuits_batch, fanning chunks of them out across a pool of worker
+    processes when workers > 1. Only 2 chunks per worker are in flight at a time.
+    :param blocks: iterable of 2^k 8-bit intensity values for each pixel in each image subset, which is only read
+        as chunks are sent out, so it may be a generator
+    :param batch_size: number of image circuits simulated together in one Aer job
+    :param workers: number of worker processes, 1 teleports the blocks in this process
+    :param chunk_size: number of blocks sent to a worker at a time, batch_size by default
+    :param progress: optional function called as progress(blocks done, total blocks) when a chunk is completed
+    :param total: total number of blocks reported to progress, len(blocks) by default
+    :param backend: name of the simulator backend, see run_circuits_batch
+    :param shots_used: optional list, the shots spent on each block are appended to it (see summarize_shots)
+    :param cache: optional BlockCache, blocks found in it are not teleported again. Leave it out for runs that need
+        every block to be sampled independently.
+    :param metrics: optional Metrics, which the metrics of every chunk (including those of the workers) are added to
+    :param noise: bit flip probability of the measurements (and tolerated by the decoder), see run_circuits_batch
+    :param teleport_mode: how the teleportation is compiled, see run_circuits_batch
+    :param initial_shots: shots of the first sampling round of each block, see run_circuits_batch
+    :param max_shots: maximum total shots per block, see run_circuits_batch
+    :param tolerance: bit flip probability tolerated by the decoder, see run_circuits_batch
+    :param min_confidence: confidence each pixel must be decoded with, see run_circuits_batch
+    :return: generator of the teleported image subsets, in the order of blocks"""
+    if chunk_size is None:
+        chunk_size = batch_size
+    if total is None:
+        total = len(blocks)
+    done = 0
+
+    # simulation settings that the teleported blocks depend on, besides their contents
+    sampling = {'initial_shots': initial_shots, 'max_shots': max_shots, 'tolerance': tolerance,
+                'min_confidence': min_confidence}
+    fingerprint = _cache_fingerprint(backend, noise, **sampling)
+
+    if workers <= 1:
+        for chunk in _chunks(blocks, chunk_size):
+            keys, cached, missing_keys, missing = _lookup_chunk(chunk, cache, fingerprint)
+            processed, chunk_shots, chunk_metrics = _teleport_chunk(missing, batch_size, backend, metrics is not None,
+                                                                     noise, teleport_mode, sampling)
+            processed = _fill_chunk(keys, cached, missing_keys, processed, cache)
+            if (shots_used is not None):
+                shots_used.extend(chunk_shots)
+            if (metrics is not None):
+                metrics.merge(chunk_metrics)
+            done += len(processed)
+            if progress is not None:
+                progress(done, total)
+            yield from processed
+        return
+
+    # Worker processes are spawned rather than forked, as forking after Aer has started its OpenMP threads
+    # in this process can deadlock the workers.
+    chunks = _chunks(blocks, chunk_size)
+    first = next(chunks, None)
+    if first is None:
+        return
+    chunks = enumerate(itertools.chain([first], chunks))
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(get_position_qubits(first[0]), backend, teleport_mode)) as executor:
+        # futures of the chunks in flight (with their cache lookups), and the results of completed chunks waiting
+        # on earlier ones. Only the blocks missing from the cache are sent to the workers.
+        futures = {}
+        lookups = {}
+        finished = {}
+        next_chunk = 0
+
+        def submit(index, chunk):
+            lookups[index] = _lookup_chunk(chunk, cache, fingerprint)
+            futures[executor.submit(_teleport_chunk, lookups[index][3], batch_size, backend,
+                                    metrics is not None, noise, teleport_mode, sampling)] = index
+
+        for index, chunk in itertools.islice(chunks, 2*workers):
+            submit(index, chunk)
+
+        while futures:
+            completed, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in completed:
+                index = futures.pop(future)
+                keys, cached, missing_keys, _ = lookups.pop(index)
+                processed, chunk_shots, chunk_metrics = future.result()
+                finished[index] = _fill_chunk(keys, cached, missing_keys, processed, cache)
+                if (shots_used is not None):
+                    shots_used.extend(chunk_shots)
+                if (metrics is not None):
+                    metrics.merge(chunk_metrics)
+                done += len(finished[index])
+                if progress is not None:
+                    progress(done, total)
+
+            # reassemble the teleported blocks in their original order
+            while next_chunk in finished:
+                yield from finished.pop(next_chunk)
+                next_chunk += 1
+
+            for index, chunk in itertools.islice(chunks, len(completed)):
+                submit(index, chunk)
 
 def sample_bits(bits, selection):
     """
@@ -265,45 +914,67 @@ def encode_message(bits, bases):
     """
     Alice encodes each bit onto a qubit using the basis X or Z inputted (randomly).
     0 maps to Z basis and 1 maps to X basis.
-    :return: list of quantum circuits, which represent alice's messsage to bob.
-    """
-    message = []
-    for i in range(len(bits)):
-        qc = QuantumCircuit(1,1)
-        if bases[i] == 0: # Prepare qubit in Z-basis
-            if bits[i] == 0:
-                pass
-            else:
-                qc.x(0)
-        else: # Prepare qubit in X-basis
-            if bits[i] == 0:
-                qc.h(0)
-            else:
-                qc.x(0)
-                qc.h(0)
-        qc.barrier()
-        message.append(qc)
+    There are only 4 different qubits alice can prepare this way, so rather than creating a circuit for every
+    qubit, one circuit is created for each (bit, basis) pair, along with the positions of the qubits it prepares.
+    :return: dictionary of (quantum circuit, qubit positions) for each (bit, basis) pair, which represent alice's
+    messsage to bob.
+    """
+    bits = np.asarray(bits)
+    bases = np.asarray(bases)
+    message = {}
+    for bit in (0, 1):
+        for basis in (0, 1):
+            qc = QuantumCircuit(1,1)
+            if basis == 0: # Prepare qubit in Z-basis
+                if bit == 0:
+                    pass
+                else:
+                    qc.x(0)
+            else: # Prepare qubit in X-basis
+                if bit == 0:
+                    qc.h(0)
+                else:
+                    qc.x(0)
+                    qc.h(0)
+            qc.barrier()
+            message[(bit, basis)] = (qc, np.flatnonzero((bits == bit) & (bases == basis)))
     return message
 
 def measure_message(message, bases):
     """
     Bob measures each qubit sent to him by Alice in a randomly chosen
     basis (X or Z), then stores this classical information.
+
+    Every qubit is measured in a single Aer job: each distinct circuit (alice's preparation followed by bob's
+    measurement basis) is one experiment, with a shot for every qubit that was prepared and measured that way.
+    These circuits are Clifford-only, so they are simulated with the stabilizer method.
     :return: list of measurements that bob performed
     """
-    measurements = []
-    for q in range(len(bases)):
-        if bases[q] == 0: # measuring in Z-basis
-            message[q].measure(0,0)
-        if bases[q] == 1: # measuring in X-basis
-            message[q].h(0)
-            message[q].measure(0,0)
-        aer_sim = Aer.get_backend('aer_simulator')
-        qobj = assemble(message[q], shots=1, memory=True)
-        result = aer_sim.run(qobj).result()
-        measured_bit = int(result.get_memory()[0])
-        measurements.append(measured_bit)
-    return measurements
+    bases = np.asarray(bases)
+    circuits = []
+    positions = []
+    for qc, qubits in message.values():
+        for basis in (0, 1):
+            measured = qubits[bases[qubits] == basis]
+            if len(measured) == 0:
+                continue
+            qc_bob = qc.copy()
+            if basis == 1: # measuring in X-basis
+                qc_bob.h(0)
+            qc_bob.measure(0,0)
+            circuits.append(qc_bob)
+            positions.append(measured)
+
+    # Every experiment of a job has the same number of shots, so each uses the first shots of its memory.
+    aer_sim = get_backend('aer_simulator')
+    shot_count = max(len(measured) for measured in positions)
+    result = aer_sim.run(circuits, shots=shot_count, memory=True, method='stabilizer').result()
+
+    measurements = np.zeros(len(bases), dtype=int)
+    for i, measured in enumerate(positions):
+        memory = result.get_memory(i)[:len(measured)]
+        measurements[measured] = np.frombuffer("".join(memory).encode(), dtype=np.uint8) - ord('0')
+    return measurements.tolist()
 
 def remove_garbage(a_bases, b_bases, bits):
     """
@@ -313,24 +984,21 @@ def remove_garbage(a_bases, b_bases, bits):
     :return: list of bits that were measured/chosen by alice/bob
     with the same basis (X or Z).
     """
-    good_bits = []
-    for q in range(len(bits)):
-        if a_bases[q] == b_bases[q]:
-            # If both used the same basis, add
-            # this to the list of 'good' bits
-            good_bits.append(bits[q])
-    return good_bits
+    # If both used the same basis, add this to the list of 'good' bits
+    return np.asarray(bits)[np.asarray(a_bases) == np.asarray(b_bases)].tolist()
 
-def get_bb84_keys():
+def get_bb84_keys(n=100, sample_size=20, key_length=None):
     """
     BB84 is a quantum key distribution protocol used to distribute identical (ideally)
     keys to alice and bob, using a quantum channel and a classical information channel.
+    :param n: number of bits to begin BB84 protocol with. The qubits are simulated in a single batched job,
+        so this scales to 10^5-10^6 raw bits, of which about half are kept when the keys are sifted.
+    :param sample_size: number of key bits alice and bob compare (and discard) to detect eavesdroppers
+    :param key_length: number of bits to truncate the finalized keys to, or None to keep every sifted bit (as the
+        one-time pad needs a key bit for every bit of the image)
     :return: alice and bob's completed bit keys to be used for encryption/decryption.
     """
 
-    # Number of bits to begin BB84 protocol with
-    n = 100
-
     # Step 1 - alice creates n random (classical) bits and bases (X/Z)
     alice_bits = randint(2, size=n)
     alice_bases = randint(2, size=n)
@@ -350,7 +1018,6 @@ def get_bb84_keys():
     # Step 5 - random pairs of bits in their keys are checked against each other and then removed from the keys
     # as they are no longer secret. This is used to detect the influence of potential eavesdroppers and noise.
     # A larger sample_size is safer, but results in smaller keys.
-    sample_size = 20
     bit_selection = randint(n, size=sample_size)
     bob_sample = sample_bits(bob_key, bit_selection)
     alice_sample = sample_bits(alice_key, bit_selection)
@@ -377,21 +1044,389 @@ def get_bb84_keys():
     # bob's finalized key
     b_key = str_of_ints
 
-    # only need key of 8 bits, as we are encrypting/decrypting 1 byte with them
-    a_key = a_key[0:8]
-    b_key = b_key[0:8]
+    # the keys may be truncated to key_length bits, though the one-time pad consumes every sifted bit as key bytes
+    # (see KeyPool)
+    if (key_length is not None):
+        a_key = a_key[0:key_length]
+        b_key = b_key[0:key_length]
 
     return a_key, b_key
 
 def xor_encrypt(msg, key):
     """
-    Encrypt (or decrypt) a message using the key using XOR (the bitwise operator is: ^).
-    :return: 8-bit encrypted or decrypted string
+    Encrypt (or decrypt) a message using the key using XOR (the bitwise operator is: ^), byte by byte.
+    The whole message is XORed with the keystream at once as arrays of bytes.
+    :param msg: bytes, bytearray, memoryview or np.uint8 array to encrypt or decrypt
+    :param key: keystream of at least as many bytes as msg (bytes-like or np.uint8 array)
+    :return: np.uint8 array of the encrypted or decrypted bytes
+    """
+    msg = np.frombuffer(msg, dtype=np.uint8) if not isinstance(msg, np.ndarray) else msg
+    key = np.frombuffer(key, dtype=np.uint8) if not isinstance(key, np.ndarray) else key
+    return np.bitwise_xor(msg, key[:len(msg)])
+
+def payload_key_bytes(num_bytes, check_size=64, read_size=65536):
+    """
+    Number of key bytes needed to send num_bytes with send_file: one per byte, and the encrypted checksums of every
+    check_size bytes (an upper bound, as the checksums of each chunk of read_size bytes are rounded up).
     """
-    encrypted = int(msg, 2)^int(key,2)
-    return bin(encrypted)[2:].zfill(len(msg))
+    if (check_size is None):
+        return num_bytes
+    return num_bytes + 4*(-(-num_bytes//check_size) + -(-num_bytes//read_size))
 
-def send_file(mentee_path, file_name, mentor_path):
+class KeyPool:
+    """
+    Pool of one-time pad key material for alice and bob, as long as the data it encrypts. A background thread runs
+    BB84 rounds (see get_bb84_keys) ahead of demand: whenever fewer than low_watermark key bytes are left in the
+    pool, it distributes keys until the pool holds high_watermark bytes again (or enough for a pending request).
+    A pool serving a known amount of data can be given a max_bytes budget, so that it does not distribute more.
+    Alice's and bob's keystreams are kept in matched buffers, and taken from the pool byte for byte in the same
+    order. metrics() reports how often the pool ran dry and how long taking key bytes stalled.
+    """
+
+    def __init__(self, low_watermark=65536, high_watermark=262144, round_bits=100000, sample_size=None,
+                 max_bytes=None):
+        """
+        :param low_watermark: number of pooled key bytes below which BB84 rounds are run to refill the pool
+        :param high_watermark: number of pooled key bytes the pool is refilled up to
+        :param round_bits: number of raw bits of each BB84 round, about 1/16 of which become key bytes
+        :param sample_size: number of bits compared (and discarded) each round, 1% of round_bits by default
+        :param max_bytes: number of key bytes after which the pool stops refilling ahead of demand (it still
+            distributes keys for a take that would otherwise wait forever), or None for no limit
+        """
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.round_bits = round_bits
+        self.sample_size = sample_size if sample_size is not None else max(20, round_bits//100)
+        self.max_bytes = max_bytes
+
+        # pooled key bytes, and sifted key bits that do not make up a whole byte yet
+        self._alice = bytearray()
+        self._bob = bytearray()
+        self._alice_bits = ''
+        self._bob_bits = ''
+
+        # number of key bytes a caller of take is waiting on
+        self._demand = 0
+
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._error = None
+
+        self._metrics = {'rounds': 0, 'bytes_generated': 0, 'bytes_consumed': 0, 'dry': 0, 'stall_seconds': 0.0,
+                         'bb84_seconds': 0.0}
+
+    @classmethod
+    def for_payload(cls, key_bytes):
+        """
+        Pool for a known amount of data, which distributes no more than key_bytes key bytes (see payload_key_bytes),
+        holding no more than the default watermarks of them at a time, in BB84 rounds no larger than needed.
+        """
+        return cls(low_watermark=min(key_bytes, 65536), high_watermark=min(key_bytes, 262144),
+                   round_bits=min(100000, 20*key_bytes + 160), max_bytes=key_bytes)
+
+    def start(self):
+        """Start the background thread distributing keys, which take also does if it has not been started (or if
+        it failed)."""
+        with self._condition:
+            if self._thread is None:
+                self._stopped = False
+                self._error = None
+                self._thread = threading.Thread(target=self._refill, name="KeyPool", daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """
+        Stop the background thread, once its current BB84 round is complete.
+        :param wait: whether to wait for the current round, or return at once and let the round be discarded
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+            thread = self._thread
+            self._thread = None
+        if thread is not None and wait:
+            thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _target(self):
+        """Number of key bytes the pool is being refilled up to."""
+        target = self.high_watermark
+        if self.max_bytes is not None:
+            target = min(target, len(self._alice) + max(0, self.max_bytes - self._metrics['bytes_generated']))
+        return max(target, self._demand)
+
+    def _retired(self):
+        """Whether the calling background thread was stopped (it may be replaced by another once stop returns)."""
+        return self._stopped or self._thread is not threading.current_thread()
+
+    def _refill(self):
+        """Background thread: run BB84 rounds whenever the pool falls below its low watermark."""
+        while True:
+            with self._condition:
+                while (not self._retired() and len(self._alice) >= min(self.low_watermark, self._target())
+                       and len(self._alice) >= self._demand):
+                    self._condition.wait()
+                if self._retired():
+                    return
+
+            while True:
+                with self._condition:
+                    if self._retired() or len(self._alice) >= self._target():
+                        break
+
+                # BB84 is run without holding the lock, so key bytes can still be taken in the meantime
+                try:
+                    start = time.perf_counter()
+                    a_key, b_key = get_bb84_keys(self.round_bits, self.sample_size, key_length=None)
+                    bb84_seconds = time.perf_counter() - start
+                except BaseException as error:
+                    # get_bb84_keys exits when the keys do not match, which is passed on to the takes waiting for
+                    # this round instead. The next take starts a new thread, so a long-lived pool recovers.
+                    with self._condition:
+                        if not self._retired():
+                            self._error = error
+                            self._thread = None
+                            self._condition.notify_all()
+                    return
+
+                with self._condition:
+                    # the keys of a round completed after stop are discarded
+                    if self._retired():
+                        return
+                    a_bytes, self._alice_bits = _bits_to_bytes(self._alice_bits + a_key)
+                    b_bytes, self._bob_bits = _bits_to_bytes(self._bob_bits + b_key)
+                    self._alice += a_bytes
+                    self._bob += b_bytes
+                    self._metrics['rounds'] += 1
+                    self._metrics['bytes_generated'] += len(a_bytes)
+                    self._metrics['bb84_seconds'] += bb84_seconds
+                    self._condition.notify_all()
+
+    def take(self, num_bytes):
+        """
+        Take the next num_bytes key bytes of alice and bob from the pool, waiting for them if the pool has run dry.
+        :return: alice's and bob's key bytes
+        """
+        self.start()
+        with self._condition:
+            if len(self._alice) < num_bytes and self._error is None:
+                # the pool has run dry, wait until the background thread has distributed enough key bytes
+                self._metrics['dry'] += 1
+                start = time.perf_counter()
+                self._demand = num_bytes
+                self._condition.notify_all()
+                while len(self._alice) < num_bytes and self._error is None:
+                    self._condition.wait()
+                self._demand = 0
+                self._metrics['stall_seconds'] += time.perf_counter() - start
+            if len(self._alice) < num_bytes:
+                # the round this take was waiting for failed, the next take restarts the background thread
+                raise RuntimeError("BB84 key distribution failed, keys could not be distributed") from self._error
+
+            a_bytes = bytes(self._alice[:num_bytes])
+            b_bytes = bytes(self._bob[:num_bytes])
+            del self._alice[:num_bytes]
+            del self._bob[:num_bytes]
+            self._metrics['bytes_consumed'] += num_bytes
+
+            if len(self._alice) < self.low_watermark:
+                self._condition.notify_all()
+        return a_bytes, b_bytes
+
+    def metrics(self):
+        """
+        :return: dictionary of the BB84 rounds run and seconds spent on them, key bytes generated and consumed, bytes
+        currently pooled, number of times the pool ran dry, and seconds spent waiting on it
+        """
+        with self._condition:
+            metrics = dict(self._metrics)
+            metrics['pooled_bytes'] = len(self._alice)
+        return metrics
+
+def _bits_to_bytes(bits):
+    """Convert a string of key bits to bytes.
+    :return: the bytes, and the leftover bits that do not make up a whole byte"""
+    whole = len(bits)//8*8
+    if whole == 0:
+        return b'', bits
+    return int(bits[:whole], 2).to_bytes(whole//8, 'big'), bits[whole:]
+
+def _rle_encode(data):
+    """Encode bytes as runs: each run of up to 255 identical bytes becomes its length followed by the byte."""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if (not len(data)):
+        return b''
+    starts = np.flatnonzero(np.r_[True, data[1:] != data[:-1]])
+    lengths = np.diff(np.r_[starts, len(data)])
+
+    # runs longer than 255 bytes are split into several runs, all of 255 bytes but the last
+    pieces = -(-lengths//255)
+    run_lengths = np.full(pieces.sum(), 255)
+    run_lengths[np.cumsum(pieces)-1] = lengths - 255*(pieces-1)
+    return np.stack([run_lengths, np.repeat(data[starts], pieces)], axis=1).astype(np.uint8).tobytes()
+
+class RLECompressor:
+    """Streaming run-length encoder (see _rle_encode), with the compress/flush interface of zlib.compressobj."""
+
+    def __init__(self):
+        self._pending = b''
+
+    def compress(self, data):
+        # the last run may carry on in the next data, so it is held back (apart from whole runs of 255 bytes)
+        data = self._pending + bytes(data)
+        if (not data):
+            return b''
+        others = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) != data[-1])
+        last = others[-1]+1 if len(others) else 0
+        last = len(data) - (len(data)-last) % 255
+        self._pending = data[last:]
+        return _rle_encode(data[:last])
+
+    def flush(self):
+        data, self._pending = self._pending, b''
+        return _rle_encode(data)
+
+class RLEDecompressor:
+    """Streaming run-length decoder, with the decompress/flush interface of zlib.decompressobj."""
+
+    def __init__(self):
+        self._pending = b''
+
+    def decompress(self, data):
+        data = self._pending + bytes(data)
+        whole = len(data)//2*2
+        self._pending = data[whole:]
+        runs = np.frombuffer(data[:whole], dtype=np.uint8).reshape(-1, 2)
+        return np.repeat(runs[:, 1], runs[:, 0]).tobytes()
+
+    def flush(self):
+        if self._pending:
+            raise ValueError("run-length encoded data ended in the middle of a run")
+        return b''
+
+# compression codecs of send_file, as factories of their streaming compressor and decompressor. Other codecs can be
+# added, or passed to send_file directly, in the same form.
+COMPRESSION_CODECS = {
+    'zlib': (lambda: zlib.compressobj(9), zlib.decompressobj),
+    'lzma': (lzma.LZMACompressor, lzma.LZMADecompressor),
+    'rle': (RLECompressor, RLEDecompressor),
+}
+
+# leading bytes (magic numbers) of file formats which are already compressed
+_COMPRESSED_MAGIC = (
+    b'\xff\xd8\xff',  # JPEG
+    b'\x89PNG\r\n\x1a\n',  # PNG
+    b'GIF87a', b'GIF89a',  # GIF
+    b'PK\x03\x04',  # ZIP (and formats based on it)
+    b'\x1f\x8b',  # gzip
+    b'\xfd7zXZ\x00',  # xz
+    b'BZh',  # bzip2
+    b'7z\xbc\xaf\x27\x1c',  # 7z
+    b'\x28\xb5\x2f\xfd',  # zstd
+)
+
+def is_compressed(header):
+    """Check whether the first bytes of a file belong to a format which is already compressed (such as JPEG or PNG),
+    which compression would not shrink any further."""
+    return header.startswith(_COMPRESSED_MAGIC) or (header[:4] == b'RIFF' and header[8:12] == b'WEBP')
+
+def compress_file(image, compression, read_size=65536):
+    """
+    Compress an open file into a temporary file (kept in memory up to 16 MB), read_size bytes at a time.
+    :param image: file opened in binary mode
+    :param compression: name of a codec in COMPRESSION_CODECS, or a (compressor, decompressor) pair of factories
+    :param read_size: number of bytes read at a time
+    :return: the compressed temporary file, rewound, or None if the file is already in a compressed format or did not
+        shrink (in which case the file is rewound and should be sent as is)
+    """
+    compressor, _ = COMPRESSION_CODECS[compression] if isinstance(compression, str) else compression
+    start = image.tell()
+    if is_compressed(image.read(16)):
+        image.seek(start)
+        return None
+    image.seek(start)
+
+    compressed = tempfile.SpooledTemporaryFile(max_size=2**24)
+    compressor = compressor()
+    chunk = image.read(read_size)
+    while chunk:
+        compressed.write(compressor.compress(chunk))
+        chunk = image.read(read_size)
+    compressed.write(compressor.flush())
+
+    if (compressed.tell() >= image.tell() - start):
+        compressed.close()
+        image.seek(start)
+        return None
+    compressed.seek(0)
+    return compressed
+
+def read_blocks(image, keystream, read_size=65536, block_size=4, metrics=None, on_chunk=None):
+    """
+    Read an open file read_size bytes at a time, encrypt each byte with its own key byte, and split the encrypted
+    bytes into groups of block_size to be teleported. If the file isn't a multiple of block_size bytes, the last group
+    is padded with 0s.
+    :param image: file opened in binary mode
+    :param keystream: function returning the next n key bytes when called as keystream(n)
+    :param read_size: number of bytes read at a time, rounded up to a multiple of block_size
+    :param block_size: number of bytes (pixels) in each group
+    :param metrics: optional Metrics, timing the encryption stage
+    :param on_chunk: optional function called as on_chunk(chunk, encrypted) with each chunk of bytes read, and its
+        encrypted groups as an array of shape (groups, block_size), before they are teleported
+    :return: generator of groups of block_size encrypted bytes (as ints)
+    """
+    read_size = -(-read_size//block_size)*block_size
+    chunk = image.read(read_size)
+    while chunk:
+        # encrypt the whole chunk using the key (one-time pad), padded with 0s up to a multiple of block_size
+        key = keystream(len(chunk))
+        with _timer(metrics, 'encryption'):
+            encrypted = np.zeros(-(-len(chunk)//block_size)*block_size, dtype=np.uint8)
+            encrypted[:len(chunk)] = xor_encrypt(chunk, key)
+            if (metrics is not None):
+                metrics.count('bytes', len(chunk))
+        encrypted = encrypted.reshape(-1, block_size)
+        if (on_chunk is not None):
+            on_chunk(chunk, encrypted)
+        yield from encrypted.tolist()
+        chunk = image.read(read_size)
+
+def group_checksums(data, check_size):
+    """CRC32 checksum of each group of check_size bytes of data (the last group may be shorter).
+    :return: array of the checksums, as unsigned 32-bit integers"""
+    return np.array([zlib.crc32(data[i:i+check_size]) for i in range(0, len(data), check_size)], dtype=np.uint32)
+
+def _compression_name(compression, compressed):
+    """:return: name of the codec a transfer was compressed with (see send_file), or None if it was not compressed"""
+    if compressed is None:
+        return None
+    return compression if isinstance(compression, str) else 'custom'
+
+def read_checkpoint(path):
+    """:return: the checkpoint saved at path by send_file (see write_checkpoint), or None if there is none"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_checkpoint(path, checkpoint):
+    """Save the checkpoint of a transfer to path as JSON. It is written to a temporary file first and then renamed,
+    so that a transfer killed in the middle of it still leaves the previous checkpoint intact."""
+    with open(path+".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path+".tmp", path)
+
+def send_file(mentee_path, file_name, mentor_path, batch_size=64, workers=1, read_size=65536, position_qubits=2,
+              backend='aer_simulator', key_pool=None, block_cache=None, progress=print_progress, progress_interval=0.5,
+              sinks=(print_sink,), noise=0.0, teleport_mode='dynamic', compression=None, checkpoint_interval=30.0,
+              resume=False, check_size=64, max_retries=3, checkpoint_size=256):
     """
     Creates and distributes encryption keys (to be used with XOR) using the BB84 quantum key distribution
     protocol. Mentee/alice's key is used to encrypt the image data in the origin folder. The image data is then
@@ -408,102 +1443,712 @@ def send_file(mentee_path, file_name, mentor_path):
         example: "qosf.jpg"
     :param mentor_path: path to mentor/bob's folder, which the file will be sent to 
         example: "qosf_app_final/mentor/"
+    :param batch_size: number of 4 byte groups teleported together in one simulator job
+    :param workers: number of worker processes teleporting groups in parallel
+    :param read_size: number of bytes read from the image at a time
+    :param position_qubits: number of pixel position qubits k, the image is teleported 2^k pixels at a time.
+        See plan_block_size to pick it from a qubit and shot budget.
+    :param backend: name of the simulator backend, 'aer_simulator' or the purpose-built 'numpy' engine
+    :param key_pool: KeyPool to take the one-time pad keys from, which may be shared by several transfers.
+        A new one is started (and stopped) for this transfer if None.
+    :param block_cache: optional BlockCache of teleported blocks, which may be shared by several transfers. None (or
+        False) teleports every block. As every byte is encrypted with its own fresh key byte (even when a file is sent
+        again), encrypted groups practically never repeat, so the cache is only hit by chance.
+    :param progress: function called as progress(groups done, total groups) as the teleportation progresses, at most
+        once every progress_interval seconds (see throttle_progress), or None
+    :param progress_interval: minimum number of seconds between two calls of progress
+    :param sinks: functions each called with the summary of the transfer once it is complete: a dictionary of the
+        seconds spent and runs of each stage, counters, wall time and success. See print_sink, log_sink and json_sink.
+    :param noise: bit flip probability of the measured qubits, simulated by the 'numpy' backend and tolerated by the
+        decoder, which samples noisy groups until their bytes are decoded confidently (see run_circuits_batch)
+    :param teleport_mode: 'dynamic' to teleport each qubit with mid-circuit measurements and classically conditioned
+        corrections, or 'deferred' to compile the same teleportation with every measurement at the end, which the
+        Aer simulator samples from a single final state (see teleport_image_deferred)
+    :param compression: name of a codec to compress the file with before it is encrypted ('zlib', 'lzma' or 'rle', see
+        COMPRESSION_CODECS), or None to send it as is. Files in already compressed formats (such as JPEG) are always
+        sent as is.
+    :param checkpoint_interval: number of seconds between checkpoints of the transfer, saved next to the partial file
+        in bob's folder, or None to not save any. See resume_file.
+    :param resume: whether to resume the transfer from its last checkpoint, rather than start it from scratch
+    :param check_size: number of bytes covered by each checksum (rounded up to whole groups of 2^k bytes), which bob
+        verifies after decrypting them, teleporting them again if they do not match. None to not check the bytes.
+    :param max_retries: number of times the bytes of a checksum may be teleported again before the transfer fails
+    :param checkpoint_size: maximum number of bytes read (and decrypted and written by bob) at a time when checkpoints
+        are saved, rounded up to whole checksums. A checkpoint can only advance by whole chunks, so this bounds the
+        bytes whose teleportation is lost by an interruption (about 5 s of the Aer simulator in dynamic mode).
     :return success: boolean to indicate success or failure of teleportation from mentee to mentor folder
     """
 
     # The names alice/bob will be used to indicate origin and destination folder of the image, or mentee/mentor.
 
-    # First, use BB84 to create and distribute binary keys to alice and bob, which will be used by Alice to encrypt the
+    # timers and counters of every stage of the transfer, reported to the sinks at the end
+    metrics = Metrics()
+    start = time.perf_counter()
+
+    # BB84 is used to create and distribute binary keys to alice and bob, which will be used by Alice to encrypt the
     # image data before encoding it into a quantum circuit, then teleporting it to bob, who will decode it.
-    keys = get_bb84_keys()
-    a_key = keys[0]
-    b_key = keys[1]
-
-    # open image in the first folder (alice's folder), read its contents into a bytearray
-    with open(mentee_path+file_name, "rb") as image:
-        raw_img = image.read()
-        img_origin = bytearray(raw_img)
-
-    # Used to convert from int types to 8 bit string
-    img_8bit = []
-    i = 0
-
-    # convert from int to string of 8 bits, and encrypt using alice's key
-    for xx in img_origin:
-        img_8bit .append(format(img_origin[i],'08b'))
-        img_8bit[i] = xor_encrypt(img_8bit[i], a_key)
-        i+=1
-
-    # group of bytes to be teleported, 4 at a time
-    to_teleport = []
-    tp_data = []
-    i = 0 # 4 bit data package iterator
-    j = 0 # teleport completion iterator
-
-    # Image array of 8 bit intensity values split into groups of 4 pixels, transformed into a quantum
-    # circuit, teleported to bob, and then derypted.
-    for val in img_8bit:
-        to_teleport.append(val)
-        i+=1
-
-        # Teleporting 4 bytes at a time
-        if i==4:
-            i=0
-            # 4 bytes obtained via teleportation of encrypted NEQR circuit
-            tp = run_circuits(to_teleport)
-
-            # decrypt and convert each teleported byte back to int representation.
-            for x in tp:
-
-                # decrypt using bob's key and add to list of decoded image data:
-                x = xor_encrypt(x,b_key)
-                tp_data.append(int(x,2))
-
-                # % completion tracker for user's awareness of teleportation progress
-                print("Image teleportation "+str(100*float(j)/float(len(img_8bit)))[0:4]+" % completed")
-                j+=1
-
-            # reset array of 4 bytes each time it is teleported
-            to_teleport = []
+    # Every byte is encrypted with its own key byte (one-time pad), so the keys are distributed by a key pool in the
+    # background as the image is streamed.
+    # A pool of this transfer's own is only started once the number of key bytes it needs is known (see below).
+    own_pool = key_pool is None
+    key_metrics_before = key_pool.metrics() if not own_pool else None
+
+    # Repeated groups of encrypted bytes are only teleported once, if a block cache is given. The one-time pad makes
+    # the encrypted groups look random, so there is no cache by default.
+    if block_cache is False:
+        block_cache = None
+    cache_stats_before = block_cache.stats() if block_cache is not None else None
+
+    # Bob's key bytes, taken from the pool together with alice's, are queued until the bytes they decrypt arrive.
+    bob_keystream = collections.deque()
+    def alice_keystream(num_bytes):
+        a_key, b_key = key_pool.take(num_bytes)
+        bob_keystream.append(b_key)
+        return a_key
+
+    # Alice computes a checksum of every check_size bytes before encrypting them, and sends the checksums to bob
+    # over the classical channel. They are encrypted with their own key bytes, as the checksums of a few bytes would
+    # reveal them. She keeps her encrypted groups until bob has verified them, to teleport them again if needed.
+    bob_checksums = collections.deque()
+    def alice_checksums(chunk, encrypted):
+        checksums = group_checksums(chunk, check_size).tobytes()
+        a_key, b_key = key_pool.take(len(checksums))
+        bob_checksums.append((xor_encrypt(checksums, a_key), b_key, encrypted))
+
+    # number of times the bytes at each offset of the image failed their checksum
+    failures = collections.Counter()
+
+    def verify_chunk(offset, received_chunk, b_key):
+        """Decrypt a chunk of the image received by bob, and verify its checksums, teleporting the groups of the
+        checksums that fail again until they match (or max_retries is reached).
+        :return: the decrypted chunk"""
+        with metrics.timer('decryption'):
+            decrypted = xor_encrypt(received_chunk.ravel()[:len(b_key)], b_key)
+        if (check_size is None):
+            return decrypted
+
+        sent_checksums, checksum_key, encrypted = bob_checksums.popleft()
+        with metrics.timer('verification'):
+            expected = np.frombuffer(xor_encrypt(sent_checksums, checksum_key).tobytes(), dtype=np.uint32)
+            bad = np.flatnonzero(group_checksums(decrypted, check_size) != expected)
+
+        blocks_per_check = check_size//block_size
+        for attempt in range(max_retries+1):
+            if (not len(bad)):
+                break
+            for group in bad:
+                failures[offset + int(group)*check_size] += 1
+            if (attempt == max_retries):
+                raise RuntimeError("bytes " + str(offset + int(bad[0])*check_size) + " of " + file_name + " failed "
+                                   "their checksum " + str(max_retries+1) + " times, the transfer is stopped")
+
+            # teleport alice's encrypted groups of the failed checksums again, bypassing the block cache (which
+            # holds the failed groups), and decrypt and verify them again
+            with metrics.timer('retry'):
+                retried = np.concatenate([np.arange(group*blocks_per_check,
+                                                    min((group+1)*blocks_per_check, len(encrypted))) for group in bad])
+                received_chunk[retried] = list(teleport_blocks(encrypted[retried].tolist(), batch_size, 1,
+                                                               backend=backend, shots_used=shots_used,
+                                                               metrics=metrics, noise=noise,
+                                                               teleport_mode=teleport_mode))
+                metrics.count('retried_blocks', len(retried))
+                with metrics.timer('decryption'):
+                    decrypted = xor_encrypt(received_chunk.ravel()[:len(b_key)], b_key)
+                with metrics.timer('verification'):
+                    bad = np.array([group for group in bad
+                                    if zlib.crc32(decrypted[group*check_size:(group+1)*check_size]) != expected[group]],
+                                   dtype=np.int64)
+                if (block_cache is not None):
+                    # the groups teleported again replace the failed ones in the cache
+                    fingerprint = _cache_fingerprint(backend, noise)
+                    for block, value in zip(encrypted[retried].tolist(), received_chunk[retried].tolist()):
+                        block_cache.put(BlockCache.key(block, fingerprint), value)
+        return decrypted
 
-    print("Teleportation and decryption of image complete.")
+    try:
+        # The image is streamed from alice's folder to bob's, read_size bytes at a time, so that only a bounded
+        # number of bytes are held in memory (in any stage of the pipeline) regardless of the size of the image.
+        file_size = os.path.getsize(mentee_path+file_name)
+        image = open(mentee_path+file_name, "rb")
+
+        # Every byte costs a share of a simulation, so alice may compress the image before encrypting it (unless it
+        # is already compressed), and bob decompresses it after decrypting it.
+        compressed = None
+        if (compression is not None):
+            with metrics.timer('compression'):
+                compressed = compress_file(image, compression, read_size)
+            if (compressed is None):
+                print(file_name + " is not compressed, it is already in a compressed format (or did not shrink).")
+            else:
+                image.close()
+                image = compressed
+                original_size, file_size = file_size, image.seek(0, os.SEEK_END)
+                image.seek(0)
+                codec = COMPRESSION_CODECS[compression] if isinstance(compression, str) else compression
+                decompressor = codec[1]()
+                metrics.counters['file_bytes'] = original_size
+                metrics.counters['compression_ratio'] = original_size/file_size
+                print(file_name + " compressed from " + str(original_size) + " to " + str(file_size) + " bytes.")
+
+        # groups of 2^k bytes to teleport, including the last group which is padded if the file isn't a multiple of
+        # 2^k
+        block_size = 2**position_qubits
+        if (check_size is not None):
+            check_size = -(-check_size//block_size)*block_size
+
+        # Checkpoints only advance once bob has decrypted a whole chunk, which takes read_size/throughput seconds,
+        # so chunks are kept small when checkpoints are saved. Whole checksums of whole groups are read at a time, so
+        # that no padding or extra checksum is teleported.
+        if (checkpoint_interval is not None and checkpoint_size is not None):
+            unit = check_size if check_size is not None else block_size
+            read_size = min(read_size, max(unit, -(-checkpoint_size//unit)*unit))
+
+        # % completion tracker for user's awareness of teleportation progress, reported as groups are teleported
+        # (throttled, so that large files don't flood the output)
+        report_progress = throttle_progress(progress, progress_interval) if progress is not None else None
+
+        # Bob writes the decrypted bytes into a partial file, which only replaces the destination once it is
+        # complete. If the image was compressed, the decrypted bytes are saved as they are and only decompressed
+        # at the end, so that the partial file can be resumed from any checkpoint.
+        part_path = mentor_path+file_name+".part"
+        payload_path = part_path if compressed is None else part_path+".z"
+
+        # Bob saves a checkpoint of the transfer every checkpoint_interval seconds: the bytes (and groups) of the
+        # image he has decrypted and written so far, and the key bytes consumed by them. The rest of the image only
+        # needs fresh key bytes from the key pool, so no key material has to be kept.
+        checkpoint_path = mentor_path+file_name+".checkpoint"
+        source = os.stat(mentee_path+file_name)
+        checkpoint = {'file': file_name, 'source_size': source.st_size, 'source_mtime': source.st_mtime,
+                      'position_qubits': position_qubits, 'compression': _compression_name(compression, compressed),
+                      'payload_bytes': 0, 'blocks': 0, 'key_bytes': 0}
+        saved = read_checkpoint(checkpoint_path) if resume else None
+        if (saved is None):
+            if resume:
+                print("No checkpoint of " + file_name + " was found, it is sent from the start.")
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+        else:
+            if any(saved[key] != checkpoint[key]
+                   for key in ('file', 'source_size', 'source_mtime', 'position_qubits', 'compression')):
+                raise ValueError("the checkpoint of " + file_name + " does not match the file or the transfer "
+                                 "settings, it cannot be resumed")
+            checkpoint = saved
+            print("Resuming " + file_name + " from byte " + str(checkpoint['payload_bytes']) + " of " + str(file_size))
+
+        # the groups left to teleport, after the checkpoint
+        image.seek(checkpoint['payload_bytes'])
+        total_blocks = -(-(file_size-checkpoint['payload_bytes'])//block_size)
+        last_checkpoint = time.perf_counter()
+
+        # A pool of this transfer's own distributes no more key bytes than the rest of the image and its checksums
+        # need, and only holds a bounded number of them at a time
+        if own_pool:
+            key_pool = KeyPool.for_payload(payload_key_bytes(file_size - checkpoint['payload_bytes'], check_size,
+                                                             read_size)).start()
+            key_metrics_before = key_pool.metrics()
+
+        with image, open(payload_path, "r+b" if saved is not None else "wb") as image2:
+            # the partial file is resumed from the checkpoint, dropping any bytes written after it
+            image2.truncate(checkpoint['payload_bytes'])
+            image2.seek(checkpoint['payload_bytes'])
+
+            # Image bytes encrypted by alice and split into groups of 4 pixels, to be transformed into a quantum
+            # circuit, teleported to bob, and then derypted.
+            to_teleport = read_blocks(image, alice_keystream, read_size, block_size, metrics,
+                                      alice_checksums if check_size is not None else None)
+
+            # Teleported bytes received by bob, which are decrypted a chunk at a time: each of alice's chunks was
+            # encrypted with its own key bytes, and was teleported as whole groups (its last group padded with 0s).
+            received = bytearray()
+
+            # simulator shots spent on each group, which are allocated adaptively
+            shots_used = []
+
+            # 2^k bytes for each group, obtained via teleportation of encrypted NEQR circuits (in the original order)
+            teleported = teleport_blocks(to_teleport, batch_size, workers, progress=report_progress,
+                                         total=total_blocks, backend=backend, shots_used=shots_used,
+                                         cache=block_cache, metrics=metrics, noise=noise, teleport_mode=teleport_mode)
+            try:
+                for tp in teleported:
+                    received.extend(tp)
+
+                    # decrypt each complete chunk using bob's key, dropping its padding, then append it to the image in
+                    # bob's folder
+                    while bob_keystream and len(received) >= -(-len(bob_keystream[0])//block_size)*block_size:
+                        b_key = bob_keystream.popleft()
+                        padded = -(-len(b_key)//block_size)*block_size
+                        received_chunk = np.frombuffer(received[:padded], dtype=np.uint8).reshape(-1, block_size)
+                        decrypted = verify_chunk(checkpoint['payload_bytes'], received_chunk.copy(), b_key)
+                        with metrics.timer('write'):
+                            image2.write(decrypted)
+                        del received[:padded]
+
+                        checkpoint['payload_bytes'] += len(b_key)
+                        checkpoint['blocks'] += -(-len(b_key)//block_size)
+                        checkpoint['key_bytes'] += len(b_key) + (4*-(-len(b_key)//check_size) if check_size else 0)
+                        if (checkpoint_interval is not None
+                                and time.perf_counter() - last_checkpoint >= checkpoint_interval):
+                            with metrics.timer('checkpoint'):
+                                image2.flush()
+                                write_checkpoint(checkpoint_path, checkpoint)
+                            last_checkpoint = time.perf_counter()
+            except BaseException:
+                # save a checkpoint of the bytes bob has written so far, so that the transfer can be resumed from them
+                if (checkpoint_interval is not None):
+                    image2.flush()
+                    write_checkpoint(checkpoint_path, checkpoint)
+                raise
+
+        # decompress the image received by bob
+        if (compressed is not None):
+            with metrics.timer('decompression'):
+                with open(payload_path, "rb") as payload, open(part_path, "wb") as image2:
+                    chunk = payload.read(read_size)
+                    while chunk:
+                        image2.write(decompressor.decompress(chunk))
+                        chunk = payload.read(read_size)
+                    # the rest of the decompressed image, held back by the decompressor (lzma's has no flush)
+                    if hasattr(decompressor, 'flush'):
+                        image2.write(decompressor.flush())
+            os.remove(payload_path)
+    finally:
+        # nothing needs the keys of a round still running in this transfer's own pool
+        if own_pool and key_pool is not None:
+            key_pool.stop(wait=False)
 
-    # hardcoding this last pixel because the file isn't a multiple of 4 pixels
-    tp_data.append(int('11011001',2))
+    print("Teleportation and decryption of image complete.")
 
-    # convert teleported/decrypted array of bytes to bytearray type
-    tp_data = bytearray(tp_data)
+    # BB84 runs in the key pool's thread, and the pool and cache may be shared, so only their changes during this
+    # transfer are counted
+    key_metrics = key_pool.metrics()
+    metrics.add_time('bb84', key_metrics['bb84_seconds'] - key_metrics_before['bb84_seconds'],
+                     key_metrics['rounds'] - key_metrics_before['rounds'])
+    metrics.add_time('key_wait', key_metrics['stall_seconds'] - key_metrics_before['stall_seconds'],
+                     key_metrics['dry'] - key_metrics_before['dry'])
+    metrics.count('blocks', total_blocks)
+    metrics.count('checksum_failures', sum(failures.values()))
+    metrics.counters['mean_shots'] = summarize_shots(shots_used)['mean_shots']
+
+    # Simulator time saved by compressing the image, estimated from the simulation time of the groups that were sent
+    if (compressed is not None):
+        saved_blocks = -(-original_size//block_size) - -(-file_size//block_size)
+        metrics.counters['simulation_seconds_saved'] = (metrics.seconds.get('simulation', 0.0)
+                                                        * saved_blocks / max(total_blocks, 1))
+    if block_cache is not None:
+        cache_stats = block_cache.stats()
+        metrics.count('cache_hits', cache_stats['hits'] - cache_stats_before['hits'])
+        metrics.count('cache_misses', cache_stats['misses'] - cache_stats_before['misses'])
+        lookups = metrics.counters['cache_hits'] + metrics.counters['cache_misses']
+        metrics.counters['cache_hit_rate'] = metrics.counters['cache_hits']/lookups if lookups else 0.0
 
     # to be returned, completion of the teleportation or not
     success = False
 
     try:
-        # Create new image using teleported and decrypted bytearray
-        image2 = Image.open(io.BytesIO(tp_data))
-        Image.LOAD_TRUNCATED_IMAGES = True
-
-        # save teleported & decrypted image in destination folder (Bob's folder)
-        image2.save(mentor_path+file_name)
+        # Check that the teleported & decrypted bytes form a valid image before saving it in the destination
+        # folder (Bob's folder)
+        with Image.open(part_path) as image2:
+            image2.verify()
+        os.replace(part_path, mentor_path+file_name)
 
         # Program completed. File has successfully been encrypted by alice, transformed into a quantum circuit,
         # teleported, and decrypted by Bob.
         print(file_name + " has been saved in the folder: "+mentor_path)
         success = True
 
-    except:
+    except Exception:
+        os.remove(part_path)
         print(file_name + " has NOT been saved in the folder: "+mentor_path)
         success = False
 
+    # the transfer is over either way, so it can no longer be resumed
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    # per-run summary of where the time went, sent to each sink
+    summary = metrics.snapshot()
+    summary.update({'file': file_name, 'backend': backend, 'teleport_mode': teleport_mode, 'noise': noise,
+                    'compression': _compression_name(compression, compressed), 'workers': workers,
+                    'success': success, 'wall_seconds': time.perf_counter() - start,
+                    'failed_checksums': sorted(failures.items())})
+    for sink in sinks:
+        sink(summary)
+
     return success
 
+def resume_file(mentee_path, file_name, mentor_path, **kwargs):
+    """
+    Resume a transfer of send_file that was interrupted (killed, or stopped by an error) from its last checkpoint in
+    mentor_path, rather than teleport the whole image again. If there is no checkpoint, the image is sent from the
+    start. The transfer must be resumed with the same position_qubits and compression, and the image must not have
+    changed since.
+    :param kwargs: other arguments of send_file
+    :return success: boolean to indicate success or failure of teleportation from mentee to mentor folder
+    """
+    return send_file(mentee_path, file_name, mentor_path, resume=True, **kwargs)
+
+async def send_file_async(mentee_path, file_name, mentor_path, executor=None, **kwargs):
+    """
+    Asynchronous variant of send_file: the transfer (BB84, encryption, simulation and decryption) runs in executor,
+    so that the event loop is free to run other transfers or tasks in the meantime. The Aer simulator and the NumPy
+    engine release the GIL while simulating, so transfers in a thread pool simulate concurrently, while sharing the
+    backend and circuit templates of this process.
+    :param executor: concurrent.futures executor to run the transfer in, the event loop's default one if None
+    :param kwargs: other arguments of send_file
+    :return success: boolean to indicate success or failure of teleportation from mentee to mentor folder
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(send_file, mentee_path, file_name, mentor_path,
+                                                                  **kwargs))
+
+def list_images(mentee_path):
+    """:return: names of the files in mentee_path with an image file extension known to PIL, in order"""
+    extensions = Image.registered_extensions()
+    return sorted(name for name in os.listdir(mentee_path) if os.path.isfile(os.path.join(mentee_path, name))
+                  and os.path.splitext(name)[1].lower() in extensions)
+
+async def send_directory_async(mentee_path, mentor_path, file_names=None, max_concurrency=4, key_pool=None,
+                               **kwargs):
+    """
+    Send every image of mentee_path to mentor_path, running up to max_concurrency transfers at a time (see
+    send_file_async). The transfers share one BB84 key pool, and the simulator backend and its circuit template are
+    warmed up once, before any transfer starts. A transfer that fails does not stop the others.
+    :param mentee_path: path to mentee/alice's folder, containing the images to be sent
+    :param mentor_path: path to mentor/bob's folder, created if it does not exist
+    :param file_names: names of the files to send, every image in mentee_path if None (see list_images)
+    :param max_concurrency: maximum number of files transferred at the same time
+    :param key_pool: KeyPool shared by the transfers, a new one sized to the files is started (and stopped) if None
+    :param kwargs: other arguments of send_file, which are the same for every file. Progress is not reported and no
+        summary is printed by default, as the transfers run concurrently.
+    :return: dictionary of the result of each file: its success, size (0 if it could not be read), seconds taken,
+        throughput in bytes per second, and the summary of its transfer (None if it failed with an error, which is
+        given instead)
+    """
+    if (file_names is None):
+        file_names = list_images(mentee_path)
+    os.makedirs(mentor_path, exist_ok=True)
+    kwargs.setdefault('progress', None)
+    sinks = tuple(kwargs.pop('sinks', ()))
+
+    # warm up the backend and the circuit template shared by every transfer
+    backend = kwargs.get('backend', 'aer_simulator')
+    if (backend != 'numpy'):
+        get_circuit_template(get_backend(backend), kwargs.get('position_qubits', 2),
+                             kwargs.get('teleport_mode', 'dynamic'))
+
+    # A pool of the transfers' own distributes no more key bytes than the files and their checksums need (an upper
+    # bound, the files being read in chunks of at least checkpoint_size bytes while checkpoints are saved)
+    own_pool = key_pool is None
+    if own_pool:
+        read_size = kwargs.get('read_size', 65536)
+        if (kwargs.get('checkpoint_interval', 30.0) is not None and kwargs.get('checkpoint_size', 256) is not None):
+            read_size = min(read_size, kwargs.get('checkpoint_size', 256))
+        key_bytes = 0
+        for file_name in file_names:
+            path = os.path.join(mentee_path, file_name)
+            if os.path.isfile(path):
+                key_bytes += payload_key_bytes(os.path.getsize(path), kwargs.get('check_size', 64), read_size)
+        key_pool = KeyPool.for_payload(key_bytes).start()
+
+    results = {}
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def transfer(file_name, executor):
+        async with semaphore:
+            summaries = []
+            start = time.perf_counter()
+            result = {'error': None, 'bytes': 0}
+            try:
+                # a file that cannot be read fails its own transfer, with the others carrying on
+                result['bytes'] = os.path.getsize(os.path.join(mentee_path, file_name))
+                result['success'] = await send_file_async(mentee_path, file_name, mentor_path, executor,
+                                                          key_pool=key_pool, sinks=sinks + (summaries.append,),
+                                                          **kwargs)
+            except Exception as error:
+                result['success'] = False
+                result['error'] = repr(error)
+            result['seconds'] = time.perf_counter() - start
+            result['bytes_per_s'] = result['bytes'] / result['seconds']
+            result['summary'] = summaries[0] if summaries else None
+            results[file_name] = result
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            await asyncio.gather(*(transfer(file_name, executor) for file_name in file_names))
+    finally:
+        if own_pool:
+            key_pool.stop(wait=False)
+    return results
+
+def send_directory(mentee_path, mentor_path, file_names=None, max_concurrency=4, **kwargs):
+    """Send every image of mentee_path to mentor_path, see send_directory_async.
+    :return: dictionary of the result of each file"""
+    return asyncio.run(send_directory_async(mentee_path, mentor_path, file_names, max_concurrency, **kwargs))
+
+class TeleportService:
+    """
+    Long-running teleportation service, which keeps a BB84 key pool, simulator backends and their circuit templates
+    warm in memory, so that transfers don't pay for them each time. Transfer requests are queued and run by a pool
+    of max_concurrency threads. Once max_queue requests are waiting, new ones are refused until the queue drains
+    (backpressure), rather than queued without bound. See serve for its HTTP interface.
+
+    Any local user may submit requests, so transfers only read images inside mentee_root and only write inside
+    mentor_root (following symbolic links), and file names may not contain a directory.
+    """
+
+    # arguments of send_file which requests may set
+    OPTIONS = ('batch_size', 'workers', 'read_size', 'position_qubits', 'backend', 'noise', 'teleport_mode',
+               'compression', 'checkpoint_interval', 'resume', 'check_size', 'max_retries', 'checkpoint_size')
+
+    def __init__(self, max_concurrency=2, max_queue=16, warm=(('aer_simulator', 2, 'dynamic'),), max_jobs=1000,
+                 mentee_root=os.path.join(".", "mentee"), mentor_root=os.path.join(".", "mentor")):
+        """
+        :param max_concurrency: number of transfers run at the same time
+        :param max_queue: number of transfers waiting to run, beyond which requests are refused
+        :param warm: (backend, position_qubits, teleport_mode) of each circuit template warmed up at start
+        :param max_jobs: number of jobs whose results are kept, the oldest are forgotten first
+        :param mentee_root: folder the images are sent from, which the mentee_path of each request must be inside
+        :param mentor_root: folder the images are sent to (created at start), which the mentor_path of each request
+            must be inside
+        """
+        self.mentee_root = os.path.realpath(mentee_root)
+        self.mentor_root = os.path.realpath(mentor_root)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.warm = warm
+        self.max_jobs = max_jobs
+        self.key_pool = KeyPool()
+        self._executor = None
+        self._lock = threading.Lock()
+        self._jobs = collections.OrderedDict()
+        self._ids = itertools.count(1)
+        self._pending = 0
+
+    def start(self):
+        """Warm up the key pool, backends and circuit templates, and start the pool of threads running transfers."""
+        os.makedirs(self.mentor_root, exist_ok=True)
+        self.key_pool.start()
+        for backend, position_qubits, teleport_mode in self.warm:
+            if (backend != 'numpy'):
+                get_circuit_template(get_backend(backend), position_qubits, teleport_mode)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        return self
+
+    def stop(self):
+        """Wait for the queued transfers to finish, and stop the key pool."""
+        self._executor.shutdown(wait=True)
+        self.key_pool.stop()
+
+    def submit(self, request):
+        """
+        Queue a transfer request: a dictionary of the mentee_path, file_name and mentor_path of send_file, and
+        optionally a dictionary of options (see OPTIONS).
+        :return: the job of the transfer and its future, or None if the queue is full
+        """
+        options = request.get('options', {})
+        unknown = set(options) - set(self.OPTIONS)
+        if unknown:
+            raise ValueError("unknown transfer options: " + ", ".join(sorted(unknown)))
+        missing = {'mentee_path', 'file_name', 'mentor_path'} - set(request)
+        if missing:
+            raise ValueError("missing transfer arguments: " + ", ".join(sorted(missing)))
+        request = dict(request, **self._resolve(request))
+
+        with self._lock:
+            if (self._pending >= self.max_concurrency + self.max_queue):
+                return None
+            self._pending += 1
+            job = {'id': str(next(self._ids)), 'file': request['file_name'], 'status': 'queued', 'success': None,
+                   'error': None, 'summary': None}
+            self._jobs[job['id']] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        return job, self._executor.submit(self._run, job, request, options)
+
+    def _resolve(self, request):
+        """
+        Check that a transfer request only reads inside mentee_root and only writes inside mentor_root.
+        :return: dictionary of the resolved mentee_path and mentor_path of the request
+        """
+        file_name = request['file_name']
+        if (not isinstance(file_name, str) or file_name in ('', '.', '..') or '/' in file_name
+                or os.sep in file_name or (os.altsep is not None and os.altsep in file_name)):
+            raise ValueError("file_name must be the name of a file, without a directory")
+
+        resolved = {}
+        for name, root in (('mentee_path', self.mentee_root), ('mentor_path', self.mentor_root)):
+            if (not isinstance(request[name], str)):
+                raise ValueError(name + " must be a path")
+            resolved[name] = os.path.join(os.path.realpath(request[name]), "")
+
+        # the image read by alice, and every file written by bob (see send_file and write_checkpoint), symbolic links
+        # included
+        paths = [(self.mentee_root, resolved['mentee_path'] + file_name)]
+        paths += [(self.mentor_root, resolved['mentor_path'] + file_name + suffix)
+                  for suffix in ("", ".part", ".part.z", ".checkpoint", ".checkpoint.tmp")]
+        for root, path in paths:
+            if (os.path.commonpath([root, os.path.realpath(path)]) != root):
+                raise ValueError(file_name + " must be sent from inside " + self.mentee_root + " to inside "
+                                 + self.mentor_root)
+        return resolved
+
+    def _run(self, job, request, options):
+        """Run a queued transfer with send_file, recording its result in its job."""
+        job['status'] = 'running'
+        summaries = []
+        try:
+            # the mentor_path was checked to be inside mentor_root, where bob's folders may be created
+            os.makedirs(request['mentor_path'], exist_ok=True)
+            job['success'] = send_file(request['mentee_path'], request['file_name'], request['mentor_path'],
+                                       key_pool=self.key_pool, progress=None, sinks=(summaries.append,), **options)
+            job['status'] = 'done'
+        except Exception as error:
+            job['success'] = False
+            job['error'] = repr(error)
+            job['status'] = 'failed'
+        finally:
+            job['summary'] = summaries[0] if summaries else None
+            with self._lock:
+                self._pending -= 1
+        return job
+
+    def job(self, job_id):
+        """:return: the job with id job_id, or None if there is none"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        """:return: dictionary of the number of transfers queued or running, and the capacity of the queue"""
+        with self._lock:
+            return {'pending': self._pending, 'max_concurrency': self.max_concurrency, 'max_queue': self.max_queue,
+                    'key_pool': self.key_pool.metrics()}
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    """HTTP interface of a TeleportService (self.server.service), see serve."""
+
+    # names the service may be reached by, besides the host it listens on
+    LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+    def _refused(self):
+        """
+        Transfers read and write files anywhere the service can, so requests are only taken from local clients: a
+        web page could otherwise submit them through the browser, with a form (which cannot send JSON without a CORS
+        preflight, which is never granted) or by rebinding its DNS name to localhost (which leaves its own name in
+        the Host header).
+        :return: whether the request was refused (and replied to)
+        """
+        host = urllib.parse.urlsplit('//' + self.headers.get('Host', '')).hostname
+        if (host not in self.LOCAL_HOSTS + (self.server.server_address[0],)):
+            self._reply(403, {'error': 'requests must be addressed to a local host name'})
+            return True
+        if ('Origin' in self.headers):
+            self._reply(403, {'error': 'requests from web pages are not accepted'})
+            return True
+        return False
+
+    def _reply(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self._refused():
+            return
+        if (self.path != '/transfers'):
+            return self._reply(404, {'error': 'not found'})
+        if (self.headers.get_content_type() != 'application/json'):
+            return self._reply(415, {'error': 'requests must be sent as application/json'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            submitted = self.server.service.submit(request)
+        except (ValueError, TypeError, AttributeError) as error:
+            return self._reply(400, {'error': str(error)})
+        if (submitted is None):
+            # backpressure: the client should retry once the queue has drained
+            return self._reply(503, {'error': 'the transfer queue is full'}, [('Retry-After', '1')])
+        job, future = submitted
+        if request.get('wait'):
+            return self._reply(200, future.result())
+        return self._reply(202, job)
+
+    def do_GET(self):
+        if self._refused():
+            return
+        if (self.path == '/health'):
+            return self._reply(200, self.server.service.stats())
+        if self.path.startswith('/transfers/'):
+            job = self.server.service.job(self.path[len('/transfers/'):])
+            if (job is not None):
+                return self._reply(200, job)
+        return self._reply(404, {'error': 'not found'})
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+def serve(host='127.0.0.1', port=8765, **kwargs):
+    """
+    Run a TeleportService as a daemon on host:port (localhost only by default), until it is interrupted. Its HTTP
+    interface takes JSON requests:
+    - POST /transfers: queue a transfer (see TeleportService.submit), replying 202 with its job, or with the job's
+      result once it is done if the request has "wait": true. 503 if the queue is full, 400 if the request is invalid.
+    - GET /transfers/<id>: the status and result of a job
+    Transfers are confined to the mentee_root and mentor_root folders of the service (see TeleportService).
+    - GET /health: the number of transfers pending and the key pool metrics
+    Requests are only accepted with a local Host header and without an Origin header (so not from web pages), and
+    transfers only as application/json.
+    client.py submits transfers to it.
+    :param kwargs: arguments of TeleportService
+    """
+    service = TeleportService(**kwargs).start()
+    server = ThreadingHTTPServer((host, port), _ServiceHandler)
+    server.service = service
+    print("Teleport service listening on http://" + host + ":" + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
 ######################### EXAMPLE ######################################################
 
 if __name__ == "__main__":
 
-    # mentee folder path, jpg (to be teleported) file name, and mentor folder path
-    mentee_path = r".\mentee\\"
-    file_name = "qosf.jpg"
-    mentor_path = r".\mentor\\"
+    parser = argparse.ArgumentParser(description="Teleport images from the mentee (alice's) folder to the mentor "
+                                                 "(bob's) folder")
+    parser.add_argument("files", nargs="*", help="names of the images to send, every image in the mentee folder if "
+                                                 "none are given")
+    parser.add_argument("--mentee", default=os.path.join(".", "mentee", ""), help="mentee folder path")
+    parser.add_argument("--mentor", default=os.path.join(".", "mentor", ""), help="mentor folder path")
+    parser.add_argument("--concurrency", type=int, default=4, help="maximum number of files sent at the same time")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes teleporting each file")
+    parser.add_argument("--backend", default='aer_simulator', help="simulator backend, aer_simulator or numpy")
+    parser.add_argument("--teleport-mode", default='dynamic', choices=sorted(TELEPORT_MODES),
+                        help="how the teleportation circuit is compiled")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_CODECS), help="compress the images before "
+                                                                                    "encrypting them")
+    parser.add_argument("--serve", action="store_true", help="run as a daemon with a warm simulator, taking transfer "
+                                                             "requests over HTTP (see client.py), which may only "
+                                                             "send images from inside --mentee to inside --mentor")
+    parser.add_argument("--port", type=int, default=8765, help="port the daemon listens on (on localhost)")
+    parser.add_argument("--max-queue", type=int, default=16, help="transfer requests the daemon queues before "
+                                                                  "refusing new ones")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(port=args.port, max_concurrency=args.concurrency, max_queue=args.max_queue,
+              warm=((args.backend, 2, args.teleport_mode),), mentee_root=args.mentee, mentor_root=args.mentor)
+        raise SystemExit
+
+    # mentee folder path, the names of the images (to be teleported), and mentor folder path
+    mentee_path = os.path.join(args.mentee, "")
+    mentor_path = os.path.join(args.mentor, "")
 
     # Check whether the specified path exists or not
     isExist = os.path.exists(mentor_path)
@@ -513,7 +2158,12 @@ if __name__ == "__main__":
         os.makedirs(mentor_path)
         print("A new directory at " + mentor_path + " has been created")
 
-    # send the image file_name from mentee_path to mentor_path
-    success = send_file(mentee_path, file_name, mentor_path)
+    # send the images from mentee_path to mentor_path, reporting the throughput of each one
+    results = send_directory(mentee_path, mentor_path, args.files or None, args.concurrency, workers=args.workers,
+                             backend=args.backend, teleport_mode=args.teleport_mode, compression=args.compression)
+    for file_name, result in results.items():
+        print("%s: %s, %d bytes in %.2f s (%.1f bytes/s)%s"
+              % (file_name, "saved" if result['success'] else "NOT saved", result['bytes'], result['seconds'],
+                 result['bytes_per_s'], " - " + result['error'] if result['error'] else ""))
 
 ####################### END OF PROGRAM #################################################
\ No newline at end of file
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from qiskit.quantum_info import Statevector
+
+import picture
+
+def random_blocks(num_blocks, block_size=4, seed=0):
+    """Random groups of 8-bit intensities, to be teleported."""
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(num_blocks, block_size)).tolist()
+
+def _split_key(key):
+    """Split a measurement key of get_counts into its crz, crx and cr parts."""
+    crz, crx, cr = key.split(' ')
+    return crz, crx, cr
+
+######################### NumPy engine vs Aer ##########################################
+
+@pytest.mark.parametrize("position_qubits", [1, 2, 3])
+def test_sample_neqr_counts_matches_aer_format(position_qubits):
+    """The NumPy engine's counts have the same keys as Aer's get_counts: crz, crx and the 8+k bit cr register, and
+    with enough shots both measure exactly the 2^k expected cr outcomes."""
+    aer_sim = picture.get_backend('aer_simulator')
+    for values in random_blocks(2, 2**position_qubits):
+        counts_aer = aer_sim.run(picture.build_templated_circuit(values, aer_sim), shots=1000).result().get_counts()
+        counts_numpy = picture.sample_neqr_counts([values], 1000)[0]
+        assert sum(counts_numpy.values()) == sum(counts_aer.values()) == 1000
+        for counts in (counts_aer, counts_numpy):
+            for key in counts:
+                crz, crx, cr = _split_key(key)
+                assert crz in ('0', '1') and crx in ('0', '1')
+                assert len(cr) == 8+position_qubits and set(cr) <= {'0', '1'}
+        expected = {format(pixel << 8 | value, '0'+str(8+position_qubits)+'b') for pixel, value in enumerate(values)}
+        assert {_split_key(key)[2] for key in counts_aer} == expected
+        assert {_split_key(key)[2] for key in counts_numpy} == expected
+
+@pytest.mark.parametrize("backend", ['aer_simulator', 'numpy'])
+def test_run_circuits_batch_backends(backend):
+    """Both backends teleport and decode every block unchanged."""
+    blocks = random_blocks(20)
+    assert picture.run_circuits_batch(blocks, 8, backend) == blocks
+
+######################### teleport modes ###############################################
+
+def ideal_distribution(values):
+    """Exact probability of every outcome (crz/crx followed by cr, as an integer) of the image circuit of values:
+    a uniformly random pixel with its intensity, and uniformly random crz/crx bits."""
+    position_qubits = picture.get_position_qubits(values)
+    probabilities = np.zeros(2**(position_qubits+10))
+    for pixel, value in enumerate(values):
+        for teleport_bits in range(4):
+            probabilities[(teleport_bits << (position_qubits+8)) | (pixel << 8) | value] = 1/(4*len(values))
+    return probabilities
+
+def deferred_distribution(values):
+    """Exact probability of every outcome of the deferred measurement image circuit of values, from its final
+    statevector (which has no mid-circuit measurements to sample)."""
+    qc_image = picture.build_image_circuit(values, 'deferred')
+    measured = {qc_image.find_bit(instruction.clbits[0]).index: qc_image.find_bit(instruction.qubits[0]).index
+                for instruction in qc_image.data if instruction.operation.name == 'measure'}
+    statevector = Statevector(qc_image.remove_final_measurements(inplace=False))
+    return statevector.probabilities([measured[clbit] for clbit in range(qc_image.num_clbits)])
+
+@pytest.mark.parametrize("position_qubits", [1, 2, 3])
+def test_deferred_circuit_is_exact(position_qubits):
+    """The deferred measurement circuit's exact outcome distribution is the ideal one."""
+    for values in random_blocks(2, 2**position_qubits, seed=position_qubits):
+        assert np.allclose(deferred_distribution(values), ideal_distribution(values))
+
+def test_teleport_modes_sample_the_same_distribution(shots=2000):
+    """The outcomes sampled by Aer from the dynamic and the deferred circuits stay within the ideal outcomes, and
+    agree in distribution."""
+    aer_sim = picture.get_backend('aer_simulator')
+    for values in random_blocks(2):
+        ideal = ideal_distribution(values)
+        sampled = {}
+        for mode in picture.TELEPORT_MODES:
+            memory = aer_sim.run(picture.build_templated_circuit(values, aer_sim, mode), shots=shots,
+                                 memory=True).result().data(0)['memory']
+            sampled[mode] = np.bincount([int(outcome, 16) for outcome in memory], minlength=len(ideal)) / shots
+            assert not sampled[mode][ideal == 0].any()
+        # total variation distance between the two sampled distributions, of about 0.05 for 2000 shots
+        assert 0.5*np.abs(sampled['dynamic'] - sampled['deferred']).sum() < 0.15
+
+@pytest.mark.parametrize("teleport_mode", sorted(picture.TELEPORT_MODES))
+def test_run_circuits_batch_teleport_modes(teleport_mode):
+    """Both teleport modes teleport and decode every block unchanged."""
+    blocks = random_blocks(8)
+    assert picture.run_circuits_batch(blocks, 8, teleport_mode=teleport_mode) == blocks